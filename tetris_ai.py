@@ -0,0 +1,262 @@
+"""Computer player that searches every reachable placement of the falling
+piece, optionally looking one piece ahead, and plays the best one.
+
+Searches run on plain lists of row bitmasks, as in GameState.bitboard,
+so they never touch the game being played. Boards reached again, by other
+moves or in another game, are looked up by their Zobrist hash in a
+transposition table instead of being searched again.
+"""
+import collections
+import multiprocessing
+from tetris_engine import Piece, Zobrist
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class Heuristic(object):
+    """Scores a board from its aggregate height, holes, bumpiness
+       and the number of rows removed. Higher is better.
+    """
+    def __init__(self, heightWeight = -0.510066, holesWeight = -0.35663, \
+            bumpinessWeight = -0.184483, linesWeight = 0.760666):
+        self.heightWeight = heightWeight
+        self.holesWeight = holesWeight
+        self.bumpinessWeight = bumpinessWeight
+        self.linesWeight = linesWeight
+
+    def evaluate(self, bitboard, cols, linesCleared):
+        """Returns the score of a board"""
+        heights = [0] * cols
+        holes, seen, rows = 0, 0, len(bitboard)
+        for i in xrange(rows):
+            row = bitboard[i]
+            holes += bin(seen & ~row).count("1")
+            new = row & ~seen
+            while new:
+                low = new & -new
+                heights[low.bit_length() - 1] = rows - i
+                new ^= low
+            seen |= row
+        bumpiness = 0
+        for j in xrange(cols - 1):
+            bumpiness += abs(heights[j] - heights[j + 1])
+        return self.heightWeight * sum(heights) + self.holesWeight * holes + \
+            self.bumpinessWeight * bumpiness + self.linesWeight * linesCleared
+
+class TranspositionTable(object):
+    """Bounded cache of search results, by keys that hold board hashes.
+       When it is full, the least recently used entry is evicted. Hits,
+       misses and evictions are counted to size it.
+    """
+    def __init__(self, capacity = 50000):
+        if capacity < 1: raise ValueError("the table must hold an entry")
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the value cached for a key, or None"""
+        entries = self.entries
+        if key not in entries:
+            self.misses += 1
+            return None
+        # moved to the end, the most recently used
+        value = entries.pop(key)
+        entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Caches the value of a key, evicting the least recently used
+           entry if the table is full"""
+        entries = self.entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self.capacity:
+            entries.popitem(last = False)
+            self.evictions += 1
+        entries[key] = value
+
+    def clear(self):
+        """Forgets every entry, keeping the counters"""
+        self.entries.clear()
+
+    @property
+    def stats(self):
+        """Returns the counters, the size and the hit rate as a dict"""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, \
+                "evictions": self.evictions, "size": len(self.entries), \
+                "capacity": self.capacity, \
+                "hitRate": float(self.hits) / lookups if lookups else 0.}
+
+class AutoPlayer(object):
+    """Finds the best moves for the falling piece of a game state.
+       heuristic can be any object with Heuristic's evaluate method.
+       With lookahead, every placement is scored by the best placement
+       of the next piece after it. With processes, the placements are
+       scored in that many worker processes. Best moves and scores are
+       cached in a TranspositionTable of tableSize entries, none if 0;
+       clear it after changing the heuristic.
+    """
+    def __init__(self, heuristic = None, lookahead = True, processes = None, \
+            tableSize = 50000):
+        self.heuristic = heuristic if heuristic != None else Heuristic()
+        self.lookahead = lookahead
+        self.processes = processes
+        self.pool = None
+        self.table = TranspositionTable(tableSize) if tableSize else None
+
+    @staticmethod
+    def fits(bitboard, cols, rotation, row, col):
+        """Returns whether a rotation fits on a board at a position"""
+        if row + rotation.height > len(bitboard) or col + rotation.left < 0 \
+           or col + rotation.right >= cols:
+            return False
+        masks = rotation.masks
+        for i in xrange(rotation.height):
+            mask = masks[i] << col if col >= 0 else masks[i] >> -col
+            if bitboard[row + i] & mask: return False
+        return True
+
+    @staticmethod
+    def lock(bitboard, cols, rotation, row, col):
+        """Returns the board after locking a rotation at a position
+           and removing full rows, with the number of rows removed
+        """
+        result = list(bitboard)
+        masks = rotation.masks
+        for i in xrange(rotation.height):
+            result[row + i] |= masks[i] << col if col >= 0 \
+                    else masks[i] >> -col
+        fullMask = (1 << cols) - 1
+        kept = [r for r in result if r != fullMask]
+        linesCleared = len(result) - len(kept)
+        return [0] * linesCleared + kept, linesCleared
+
+    @staticmethod
+    def placements(bitboard, cols, rotations, orientation, position, \
+            rotationDirection):
+        """Returns (moves, board, linesCleared) for every distinct placement
+           reachable by rotating in place, then moving sideways,
+           then dropping. Moves are the key symbols Game.keyPressed handles.
+        """
+        results, seenBoards = [], set()
+        row, col = position
+        for turns in xrange(4):
+            if turns != 0:
+                orientation = (orientation + rotationDirection) % 4
+            rotation = rotations[orientation]
+            if not AutoPlayer.fits(bitboard, cols, rotation, row, col): break
+            for step in (-1, 1):
+                target, shift = col, 0
+                while AutoPlayer.fits(bitboard, cols, rotation, row, target):
+                    if step == -1 or shift != 0:
+                        landing = row
+                        while AutoPlayer.fits(bitboard, cols, rotation, \
+                                landing + 1, target):
+                            landing += 1
+                        board, linesCleared = AutoPlayer.lock(bitboard, \
+                                cols, rotation, landing, target)
+                        key = tuple(board)
+                        if key not in seenBoards:
+                            seenBoards.add(key)
+                            moves = ["Up"] * turns + \
+                                    ["Left" if step == -1 else "Right"] * \
+                                    shift + ["Return"]
+                            results.append((moves, board, linesCleared))
+                    target += step
+                    shift += 1
+        return results
+
+    def bestMoves(self, state):
+        """Returns the best moves for the falling piece of a game state,
+           or an empty list when there is no falling piece
+        """
+        piece = state.fallingPiece
+        if piece == None or state.isOver: return []
+        table, rotationDirection = self.table, state.rules.rotationDirection
+        nextPiece = state.nextPiece if self.lookahead else None
+        nextName = None if nextPiece == None else nextPiece.name
+        if table != None:
+            # rows have their own Zobrist keys, the columns are added
+            key = (state.boardHash, state.cols, rotationDirection, \
+                    piece.name, piece.orientation, tuple(piece.position), \
+                    nextName)
+            moves = table.get(key)
+            if moves != None: return list(moves)
+        candidates = AutoPlayer.placements(state.bitboard, state.cols, \
+                Piece.knownRotations[piece.name], piece.orientation, \
+                piece.position, rotationDirection)
+        if len(candidates) == 0: return []
+        scores = self.scores(state, candidates, nextPiece)
+        best = max(xrange(len(candidates)), key = lambda i: scores[i])
+        if table != None: table.put(key, tuple(candidates[best][0]))
+        return candidates[best][0]
+
+    def scores(self, state, candidates, nextPiece):
+        """Returns the score of every candidate placement, looking up
+           the boards already scored in the table"""
+        table, cols = self.table, state.cols
+        rotationDirection = state.rules.rotationDirection
+        nextName = None if nextPiece == None else nextPiece.name
+        scores, keys = [None] * len(candidates), [None] * len(candidates)
+        if table != None:
+            for i in xrange(len(candidates)):
+                moves, board, linesCleared = candidates[i]
+                keys[i] = (Zobrist.boardHash(board), cols, \
+                        rotationDirection, linesCleared, nextName)
+                scores[i] = table.get(keys[i])
+        missing = [i for i in xrange(len(candidates)) if scores[i] == None]
+        if nextPiece != None:
+            jobs = [(candidates[i][1], candidates[i][2], cols, \
+                    Piece.knownRotations[nextPiece.name], \
+                    tuple(nextPiece.position), rotationDirection, \
+                    self.heuristic) for i in missing]
+            if self.processes and jobs:
+                if self.pool == None:
+                    self.pool = multiprocessing.Pool(self.processes)
+                found = self.pool.map(bestFollowUpScore, jobs, \
+                        max(1, len(jobs) // (4 * self.processes)))
+            else:
+                found = [bestFollowUpScore(job) for job in jobs]
+        else:
+            found = [self.heuristic.evaluate(candidates[i][1], cols, \
+                    candidates[i][2]) for i in missing]
+        for i, score in zip(missing, found):
+            scores[i] = score
+            if table != None: table.put(keys[i], score)
+        return scores
+
+    def play(self, state):
+        """Plays the best moves for the falling piece of a game state.
+           Spawns the falling piece first when there is none.
+        """
+        if state.fallingPiece == None: state.newFallingPiece()
+        for move in self.bestMoves(state):
+            state.applyMove(move)
+
+    def close(self):
+        """Stops the worker processes"""
+        if self.pool != None:
+            self.pool.terminate()
+            self.pool = None
+
+def bestFollowUpScore(job):
+    """Returns the score of the best placement of the next piece after
+       a placement, or -inf when the next piece cannot be placed.
+       Module level so that worker processes can unpickle it.
+    """
+    board, linesCleared, cols, rotations, position, rotationDirection, \
+            heuristic = job
+    best = float("-inf")
+    for moves, nextBoard, nextLinesCleared in AutoPlayer.placements(board, \
+            cols, rotations, 0, position, rotationDirection):
+        best = max(best, heuristic.evaluate(nextBoard, cols, \
+                linesCleared + nextLinesCleared))
+    return best
@@ -0,0 +1,194 @@
+"""Vectorized simulation of many independent games with numpy.
+
+Boards are packed with one bitmask per row, like GameState.bitboard, and
+an action is a placement: the orientation and the column the falling
+piece is dropped at. Pieces come from Piece.knownRotations, the piece
+sequences from PieceGenerator and scoring from GameState.clearScore, so
+a game matches the interactive game with the same seed.
+"""
+import random
+import numpy as np
+from tetris_engine import Rules, Piece, PieceGenerator, GameState
+
+class BatchGame(object):
+    """Advances count games in lockstep, one placement per game per step.
+       Every game draws its pieces from its own generator, seeded with
+       its entry of seeds.
+    """
+    def __init__(self, count, rules = Rules, seed = None, blockSize = 32):
+        if rules.cols > 64:
+            raise ValueError("BatchGame supports at most 64 columns")
+        self.count, self.rules = count, rules
+        self.rows, self.cols = rules.rows, rules.cols
+        # the narrowest unsigned integers that hold a row
+        self.dtype = np.uint16 if self.cols <= 16 else \
+                np.uint32 if self.cols <= 32 else np.uint64
+        self.fullMask = self.dtype((1 << self.cols) - 1)
+        self.learnPieces()
+        # the seeds of new games are drawn from seed
+        self.random = random.Random(seed)
+        self.seeds = np.zeros(count, np.int64)
+        self.generators = [None] * count
+        # sequences holds the blockSize piece ids of every game from
+        # position blockStarts on; piecesDrawn counts the ids taken.
+        # Refilling a block is a Python call per game, so blocks should
+        # outlast most steps; bigger ones waste draws on short games
+        self.blockSize = blockSize
+        self.sequences = np.zeros((count, blockSize), np.int64)
+        self.blockStarts = np.zeros(count, np.int64)
+        self.piecesDrawn = np.zeros(count, np.int64)
+        # full rows below the board act as its floor during collision checks
+        self.paddedBoards = np.zeros((count, self.rows + self.maxHeight), \
+                self.dtype)
+        self.paddedBoards[:, self.rows:] = self.fullMask
+        self.scores = np.zeros(count, np.int64)
+        self.pieces = np.zeros(count, np.int64)
+        self.nextPieces = np.zeros(count, np.int64)
+        self.isOver = np.zeros(count, bool)
+        self.reset()
+
+    def learnPieces(self):
+        """Packs the rotations of the known pieces into arrays.
+           Piece ids index the names list, in Piece.knownNames() order.
+        """
+        self.names = Piece.knownNames()
+        rotations = [Piece.knownRotations[name] for name in self.names]
+        count = len(rotations)
+        self.maxHeight = max(r.height for rs in rotations for r in rs)
+        self.masks = np.zeros((count, 4, self.maxHeight), self.dtype)
+        self.lefts = np.zeros((count, 4), np.int64)
+        self.minCols = np.zeros((count, 4), np.int64)
+        self.maxCols = np.zeros((count, 4), np.int64)
+        for p in range(count):
+            for o in range(4):
+                r = rotations[p][o]
+                # masks are stored against their leftmost occupied column
+                self.masks[p, o, :r.height] = [m >> r.left for m in r.masks]
+                self.lefts[p, o] = r.left
+                self.minCols[p, o] = -r.left
+                self.maxCols[p, o] = self.cols - 1 - r.right
+        spawnCols = np.array([self.cols // 2 - rs[0].width // 2 \
+                for rs in rotations], np.int64)
+        self.spawnShifts = spawnCols + self.lefts[:, 0]
+        self.spawnFits = (self.spawnShifts >= 0) & \
+                (spawnCols <= self.maxCols[:, 0])
+        self.spawnShifts = np.maximum(self.spawnShifts, 0).astype(self.dtype)
+        self.rowScores = np.array([GameState.clearScore(self.rules, c, 0) \
+                for c in range(self.maxHeight + 1)], np.int64)
+
+    @property
+    def boards(self):
+        """Returns the (count, rows) array of row bitmasks"""
+        return self.paddedBoards[:, :self.rows]
+
+    @property
+    def levels(self):
+        """Returns the level of every game, as GameState.levelOf does"""
+        scores = self.scores
+        return np.where(scores // 5 == 0, 0, (np.log(np.maximum(scores, 5) \
+                / 5.) / np.log(2)).astype(np.int64))
+
+    def drawPieces(self, which):
+        """Returns the next piece id of every game in which.
+           Only games that used up their block go back to the generator.
+        """
+        offsets = self.piecesDrawn[which] - self.blockStarts[which]
+        for k in np.flatnonzero(offsets >= self.blockSize):
+            game = which[k]
+            start = self.piecesDrawn[game]
+            self.sequences[game] = \
+                    self.generators[game].indexesAt(start, self.blockSize)
+            self.blockStarts[game], offsets[k] = start, 0
+        self.piecesDrawn[which] += 1
+        return self.sequences[which, offsets]
+
+    def reset(self, which = None):
+        """Restarts the games selected by which, or all of them"""
+        if which is None: which = np.arange(self.count)
+        which = np.asarray(which)
+        if which.dtype == bool: which = np.flatnonzero(which)
+        for game in which:
+            self.seeds[game] = self.random.getrandbits(32)
+            self.generators[game] = PieceGenerator(self.names, \
+                    int(self.seeds[game]), self.rules.pieceStrategy, \
+                    self.rules.pieceWeights, self.blockSize)
+        self.piecesDrawn[which] = 0
+        self.blockStarts[which] = -self.blockSize
+        self.paddedBoards[which, :self.rows] = 0
+        self.scores[which] = 0
+        self.pieces[which] = self.drawPieces(which)
+        self.nextPieces[which] = self.drawPieces(which)
+        self.isOver[which] = ~self.spawnFits[self.pieces[which]]
+
+    def dropRows(self, boards, pieces, orientations, shifts):
+        """Returns the row each piece lands on when dropped from the top
+           of its board, or -1 when it does not fit at the top
+        """
+        masks = self.masks[pieces, orientations] << shifts[:, None]
+        # overlaps[:, r] is nonzero when the piece collides at row r
+        overlaps = boards[:, :self.rows + 1] & masks[:, :1]
+        for h in range(1, self.maxHeight):
+            overlaps |= boards[:, h:h + self.rows + 1] & masks[:, h:h + 1]
+        return (overlaps == 0).argmin(axis = 1) - 1
+
+    def step(self, orientations, columns):
+        """Drops the falling piece of every game that is not over at the
+           given orientation and column, locks it, removes full rows and
+           spawns the next piece.
+           Columns are clamped to the board like moves against a wall.
+           A piece that does not fit at the top is dropped from its spawn
+           position instead.
+           Returns the number of rows each game removed.
+        """
+        cleared = np.zeros(self.count, np.int64)
+        which = np.flatnonzero(~self.isOver)
+        if len(which) == 0: return cleared
+        # with every game playing the boards are updated in place
+        everyGame = len(which) == self.count
+        boards = self.paddedBoards if everyGame else self.paddedBoards[which]
+        pieces = self.pieces[which]
+        orientations = np.asarray(orientations, np.int64)[which] % 4
+        columns = np.clip(np.asarray(columns, np.int64)[which], \
+                self.minCols[pieces, orientations], \
+                self.maxCols[pieces, orientations])
+        shifts = (columns + self.lefts[pieces, orientations]).astype(self.dtype)
+        rows = self.dropRows(boards, pieces, orientations, shifts)
+        blocked = rows < 0
+        if blocked.any():
+            orientations[blocked] = 0
+            shifts[blocked] = self.spawnShifts[pieces[blocked]]
+            rows[blocked] = self.dropRows(boards[blocked], pieces[blocked], \
+                    orientations[blocked], shifts[blocked])
+
+        # lock; rows past a piece's height get a zero mask
+        masks = self.masks[pieces, orientations] << shifts[:, None]
+        lockRows = rows[:, None] + np.arange(self.maxHeight)[None, :]
+        boards[np.arange(len(which))[:, None], lockRows] |= masks
+
+        # remove full rows: a stable sort moves them to the top, then clear
+        full = boards[:, :self.rows] == self.fullMask
+        counts = full.sum(axis = 1)
+        hit = np.flatnonzero(counts)
+        if len(hit) != 0:
+            order = np.argsort(~full[hit], axis = 1, kind = "stable")
+            compacted = np.take_along_axis(boards[hit, :self.rows], order, \
+                    axis = 1)
+            compacted[np.arange(self.rows)[None, :] < \
+                    counts[hit][:, None]] = 0
+            boards[hit, :self.rows] = compacted
+            gained = self.rowScores[counts[hit]]
+            if self.rules.scoringLevelDependence == 1:
+                gained = gained * (self.levels[which[hit]] + 1)
+            self.scores[which[hit]] += gained
+        cleared[which] = counts
+        if not everyGame: self.paddedBoards[which] = boards
+
+        # spawn; the game is over when the new piece does not fit
+        spawned = self.nextPieces[which]
+        self.pieces[which] = spawned
+        self.nextPieces[which] = self.drawPieces(which)
+        masks = self.masks[spawned, 0] << self.spawnShifts[spawned][:, None]
+        self.isOver[which] = \
+                ((boards[:, :self.maxHeight] & masks) != 0).any(axis = 1) | \
+                ~self.spawnFits[spawned]
+        return cleared
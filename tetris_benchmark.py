@@ -0,0 +1,319 @@
+"""Reproducible benchmarks of the engine and renderer hot paths.
+
+    python tetris_benchmark.py [-o results.json] [--compare old.json]
+
+Every case runs against the same standard boards and seeded piece
+streams, so two runs do the same work and their results can be compared
+across commits. Results are written as JSON, in seconds per operation.
+
+The Board.drawGame case needs Tk and a display, so run it under a
+virtual one, e.g. xvfb-run python2 tetris_benchmark.py. Without a
+display it is reported as skipped and the other cases still run.
+"""
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import timeit
+from tetris_engine import Rules, Piece, GameState
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class Benchmark(object):
+    """Builds the standard boards and times the cases on them"""
+    boards = ("empty", "stack", "ragged")
+    moves = ("Left", "Right", "Down", "Up")
+
+    def __init__(self, rows = Rules.defaultRows, cols = Rules.defaultCols, \
+            seed = 0, pieces = 1000):
+        Piece.learnStandardPieces()
+        self.rules = Rules()
+        self.rules.rows, self.rules.cols = rows, cols
+        self.rules.pieceStrategy, self.rules.pieceWeights = "uniform", None
+        self.seed = seed
+        self.pieces = pieces
+        self.placed = None
+
+    def newState(self, board = "empty", seed = None):
+        """Returns a started game state on one of the standard boards:
+           empty, stack (the bottom half filled but for one hole per row)
+           or ragged (columns of random heights, up to half the board)
+        """
+        seed = self.seed if seed == None else seed
+        state = GameState(self.rules, seed)
+        rng = random.Random(seed)
+        rows, cols = state.rows, state.cols
+        colors = [Piece.knownColors[name] for name in state.generator.names]
+        if board == "stack":
+            for i in xrange(rows // 2, rows):
+                hole = rng.randrange(cols)
+                for j in xrange(cols):
+                    if j != hole: state.setCell(i, j, rng.choice(colors))
+        elif board == "ragged":
+            for j in xrange(cols):
+                for i in xrange(rows - rng.randint(0, rows // 2), rows):
+                    state.setCell(i, j, rng.choice(colors))
+            # a full row would be an unreachable board
+            for i in xrange(rows):
+                if state.bitboard[i] == state.fullMask:
+                    state.setCell(i, rng.randrange(cols), state.emptyColor)
+        state.start()
+        return state
+
+    def placedStates(self):
+        """Returns states whose falling piece is set to every orientation
+           and column of every piece, near the top and in the middle of
+           every standard board, legal or not. They are built once.
+        """
+        if self.placed != None: return self.placed
+        states, k = [], 0
+        for board in Benchmark.boards:
+            for name in sorted(Piece.knownShapes):
+                for orientation in xrange(4):
+                    rotation = Piece.knownRotations[name][orientation]
+                    for row in (0, self.rules.rows // 2 - 1):
+                        for col in xrange(-rotation.left, \
+                                self.rules.cols - rotation.right):
+                            state = self.newState(board, self.seed + k)
+                            piece = Piece(name, state.cols)
+                            piece.orientation = orientation
+                            piece.position = [row, col]
+                            state.fallingPiece = piece
+                            states.append(state)
+                            k += 1
+        self.placed = states
+        return states
+
+    @staticmethod
+    def repeatOver(items, count):
+        """Returns count items, cycling through items"""
+        return [items[i % len(items)] for i in xrange(count)]
+
+    def timeIsLegal(self, count):
+        states = Benchmark.repeatOver(self.placedStates(), count)
+        start = timeit.default_timer()
+        for state in states:
+            state.isLegal
+        return timeit.default_timer() - start
+
+    def timeFallingPieceCells(self, count):
+        states = Benchmark.repeatOver(self.placedStates(), count)
+        start = timeit.default_timer()
+        for state in states:
+            state.fallingPieceCells
+        return timeit.default_timer() - start
+
+    def timeShape(self, count):
+        pieces = []
+        for name in sorted(Piece.knownShapes):
+            for orientation in xrange(4):
+                piece = Piece(name, self.rules.cols)
+                piece.orientation = orientation
+                pieces.append(piece)
+        pieces = Benchmark.repeatOver(pieces, count)
+        start = timeit.default_timer()
+        for piece in pieces:
+            piece.shape
+        return timeit.default_timer() - start
+
+    def timeRemoveFullRows(self, count):
+        """Every state has its falling piece locked into rows that are
+           full at random, so 0 to 4 of them are removed"""
+        states, rng = [], random.Random(self.seed)
+        for k in xrange(count):
+            state = self.newState("stack", self.seed + k)
+            state.newFallingPiece()
+            piece = state.fallingPiece
+            piece.orientation = rng.randrange(4)
+            rotation = piece.rotation
+            piece.position = [rng.randint(0, state.rows - rotation.height), \
+                    rng.randint(-rotation.left, \
+                    state.cols - 1 - rotation.right)]
+            for i in xrange(rotation.height):
+                if rng.random() < 0.5:
+                    for j in xrange(state.cols):
+                        state.setCell(piece.position[0] + i, j, piece.color)
+            state.putPieceOnBoard()
+            states.append(state)
+        start = timeit.default_timer()
+        for state in states:
+            state.removeFullRows()
+        return timeit.default_timer() - start
+
+    def timeHardDrop(self, count):
+        """Drops the spawned piece of every state, which locks it,
+           removes full rows and spawns the next one"""
+        states = []
+        for k in xrange(count):
+            state = self.newState(Benchmark.boards[k % 3], self.seed + k)
+            state.newFallingPiece()
+            states.append(state)
+        start = timeit.default_timer()
+        for state in states:
+            state.hardDrop()
+        return timeit.default_timer() - start
+
+    def playPiece(self, state, rng):
+        """Plays one piece with seeded random moves then a hard drop"""
+        for i in xrange(rng.randint(0, 6)):
+            state.applyMove(rng.choice(Benchmark.moves))
+            if state.isOver: return
+        state.applyMove("Return")
+
+    def timeGame(self, count):
+        """Plays count pieces headless, starting a new game when one ends"""
+        rng, games = random.Random(self.seed), 0
+        start = timeit.default_timer()
+        state = self.newState("empty", self.seed)
+        state.newFallingPiece()
+        for k in xrange(count):
+            self.playPiece(state, rng)
+            if state.isOver:
+                games += 1
+                state = self.newState("empty", self.seed + games)
+                state.newFallingPiece()
+        return timeit.default_timer() - start
+
+    def timeDrawGame(self, count):
+        """Times drawGame and the canvas redraw it causes, one frame per
+           move of a seeded game. Raises RuntimeError without a display.
+        """
+        try:
+            import tetris_bonus as gui
+        except (ImportError, SyntaxError) as e:
+            raise RuntimeError("the game views cannot be loaded: {0}" \
+                    .format(e))
+        try:
+            root = gui.Tk()
+        except gui.TclError as e:
+            raise RuntimeError("no display: {0}".format(e))
+        rng, games, elapsed = random.Random(self.seed), 0, 0.
+        state, board = None, None
+        try:
+            for k in xrange(count):
+                if state == None or state.isOver:
+                    if board != None: board.destroy()
+                    state = self.newState("empty", self.seed + games)
+                    state.newFallingPiece()
+                    board = gui.Board(root, state)
+                    board.pack()
+                    board.drawButtons()
+                    games += 1
+                else:
+                    state.applyMove(rng.choice(Benchmark.moves + \
+                            ("Return",)))
+                start = timeit.default_timer()
+                board.drawGame()
+                root.update_idletasks()
+                elapsed += timeit.default_timer() - start
+        finally:
+            root.destroy()
+            # the cached sprites belong to the destroyed interpreter
+            gui.PieceSprites.forget(root)
+        return elapsed
+
+    def cases(self):
+        """Returns (name, timing method, operation count, unit) tuples"""
+        return [("GameState.isLegal", self.timeIsLegal, 200000, "call"),
+                ("GameState.fallingPieceCells", self.timeFallingPieceCells, \
+                        200000, "call"),
+                ("Piece.shape", self.timeShape, 200000, "call"),
+                ("GameState.removeFullRows", self.timeRemoveFullRows, \
+                        10000, "call"),
+                ("GameState.hardDrop", self.timeHardDrop, 10000, "call"),
+                ("Board.drawGame", self.timeDrawGame, 500, "frame"),
+                ("game", self.timeGame, self.pieces, "piece")]
+
+    def run(self, repeats = 5, only = None):
+        """Runs every case, or the ones named in only, repeats times.
+           Returns the results as a JSON-ready dict.
+        """
+        results = []
+        for name, method, count, unit in self.cases():
+            if only and name not in only: continue
+            result = {"name": name, "unit": unit, "operations": count}
+            try:
+                times = sorted(method(count) / count \
+                        for i in xrange(repeats))
+            except RuntimeError as e:
+                result["skipped"] = str(e)
+            else:
+                result.update({"repeats": repeats, "best": times[0], \
+                        "median": times[len(times) // 2], \
+                        "perSecond": 1. / times[0] if times[0] else None})
+            results.append(result)
+        return {"commit": Benchmark.commit(), \
+                "python": platform.python_version(), \
+                "platform": platform.platform(), \
+                "rows": self.rules.rows, "cols": self.rules.cols, \
+                "seed": self.seed, "results": results}
+
+    @staticmethod
+    def commit():
+        """Returns the git commit being benchmarked, if there is one"""
+        try:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], \
+                    stderr = subprocess.STDOUT).decode("ascii").strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def compare(old, new, tolerance):
+        """Returns (name, old best, new best, ratio) for the cases run in
+           both results, and the names of those slower than tolerance
+           allows
+        """
+        oldBests = dict((r["name"], r["best"]) for r in old["results"] \
+                if "best" in r)
+        rows, regressions = [], []
+        for r in new["results"]:
+            if "best" not in r or r["name"] not in oldBests: continue
+            ratio = r["best"] / oldBests[r["name"]]
+            rows.append((r["name"], oldBests[r["name"]], r["best"], ratio))
+            if ratio > 1 + tolerance: regressions.append(r["name"])
+        return rows, regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = \
+            "Times the engine and renderer hot paths.")
+    parser.add_argument("-o", "--output", help = "write the JSON here")
+    parser.add_argument("--rows", type = int, default = Rules.defaultRows)
+    parser.add_argument("--cols", type = int, default = Rules.defaultCols)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--pieces", type = int, default = 1000, \
+            help = "pieces played by the game case")
+    parser.add_argument("--repeats", type = int, default = 5)
+    parser.add_argument("--case", action = "append", \
+            help = "only run this case, can be repeated")
+    parser.add_argument("--compare", metavar = "JSON", \
+            help = "compare with earlier results, fail on regressions")
+    parser.add_argument("--tolerance", type = float, default = 0.1, \
+            help = "slowdown allowed by --compare, 0.1 being 10%%")
+    args = parser.parse_args(argv)
+    results = Benchmark(args.rows, args.cols, args.seed, args.pieces) \
+            .run(args.repeats, args.case)
+    text = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        rows, regressions = Benchmark.compare(old, results, args.tolerance)
+        for name, oldBest, newBest, ratio in rows:
+            sys.stderr.write("{0:32} {1:12.3e} {2:12.3e} {3:7.2f}x\n" \
+                    .format(name, oldBest, newBest, ratio))
+        if regressions:
+            sys.stderr.write("slower: {0}\n".format(", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
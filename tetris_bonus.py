@@ -1,59 +1,82 @@
 ﻿import Tkinter as tk
 from Tkinter import *
 from tkColorChooser import askcolor
+import os
+import sys
 import time
-import random
-import math
-import copy
-
-class Rules:
-    """ Defines basic Rules of the game
-    """
-    # not customizable
-    defaultRows = 15
-    defaultCols = 10
-    defaultCellSize = 35
-    marginWidth = 30
-
-    # customizable
-    rows = 15
-    cols = 10
-    rotationDirection = -1
-    scoringMechanism = "Quadratic"
-    scoringLevelDependence = 0
-
-    @staticmethod
-    def cellSize():
-        """Returns the cell size that fits the current number of rows and cols
-        """   
-        return float(Rules.defaultCellSize) * Rules.defaultRows / Rules.rows \
-            if float(Rules.defaultRows) / Rules.rows < \
-            float(Rules.defaultCols) / Rules.cols else \
-            float(Rules.defaultCellSize) * Rules.defaultCols / Rules.cols
+import weakref
+from tetris_engine import Rules, Piece, GameState
+from tetris_ai import AutoPlayer
+from tetris_replay import Replay, ReplayRecorder, ReplayPlayer
+from tetris_profiler import FrameProfiler
+from tetris_scheduler import Scheduler
+from tetris_input import KeyRepeater
+from tetris_library import PieceLibrary
 
 class Application:
     """Presents different controllers"""
-    def __init__(self):
+    # standard and user-created pieces, kept across runs
+    libraryFile = "pieces.ttpl"
+
+    def __init__(self, replayPath = None):
         self.root = Tk()
-        
+        self.library = PieceLibrary(Application.libraryFile)
+        self.loadPieces()
+
         self.game = Game(self.root)
         self.settings = Settings(self.root)
-        self.pieceEditor = PieceEditor(self.root)
+        self.pieceEditor = PieceEditor(self.root, self.library)
         self.main = Main(self.root, [self.game, self.pieceEditor, \
                 self.settings])
         self.controllers = [self.main, self.game, self.pieceEditor,
                 self.settings]
+        if replayPath != None:
+            self.game.watchReplay(Replay.load(replayPath))
+            self.main.isActive, self.game.isActive = False, True
+
+    def loadPieces(self):
+        """Loads the piece library, or creates it with the standard
+           pieces on the first run or when it cannot be read. A library
+           that cannot be read is moved aside to a .bak file first, and
+           left alone when it cannot be.
+        """
+        path, canSave = self.library.path, True
+        try:
+            if self.library.load() != None: return
+        except (IOError, OSError, ValueError) as e:
+            sys.stderr.write("cannot load {0}: {1}\n".format(path, e))
+            try:
+                if os.path.exists(path + ".bak"): os.remove(path + ".bak")
+                os.rename(path, path + ".bak")
+                sys.stderr.write("moved {0} to {0}.bak\n".format(path))
+            except (IOError, OSError) as e:
+                sys.stderr.write("cannot move {0} aside: {1}\n".format(\
+                        path, e))
+                canSave = False
+        Piece.learnStandardPieces()
+        if not canSave: return
+        try:
+            self.library.save()
+        except (IOError, OSError) as e:
+            sys.stderr.write("cannot save {0}: {1}\n".format(path, e))
 
     def run(self):
-        """Presents the active controller"""
-        noActive = False
-        while True:
-            if noActive:
-                self.main.isActive = True
-            for controller in self.controllers:
-                while controller.isActive:
-                    controller.run()
-                noActive = controller != self.main
+        """Presents the active controller and runs the event loop.
+           Controllers ask for the next one with <<SwitchController>>.
+        """
+        self.root.bind("<<SwitchController>>", self.present)
+        self.present()
+        self.root.mainloop()
+
+    def present(self, event = None):
+        """Presents the active controller, or the Main controller
+           when none is active"""
+        for controller in self.controllers:
+            if controller.isActive:
+                controller.run()
+                return
+        self.main.isActive = True
+        self.main.run()
 
 class Controller:
     """Base class of all controllers"""
@@ -66,6 +89,11 @@ class Controller:
     def run():
         pass
 
+    def switchController(self):
+        """Lets the application present the controller now active,
+           once the current event has been handled"""
+        self.root.event_generate("<<SwitchController>>", when = "tail")
+
 class Main(Controller):
     """Controller that allows navigation to different controllers"""
     
@@ -83,7 +111,6 @@ class Main(Controller):
         self.frame.grid(sticky = tk.NW + tk.NE + tk.SE + tk.SW)
         self.menu.drawMenu()
         self.bindEvents()
-        self.frame.mainloop()
 
     def bindEvents(self):
         self.menu.tag_bind(self.menu.gameButton, "<Button-1>", self.toGame)
@@ -117,7 +144,7 @@ class Main(Controller):
 
     def resetController(self):
         """Resets the Main controller to initial state"""
-        self.frame.quit()
+        self.switchController()
         self.frame.destroy()
         self.frame = Frame(self.root)
         self.menu = MainMenu(parent = self.frame)
@@ -125,24 +152,14 @@ class Main(Controller):
 
 class PieceEditor(Controller):
     """Controller that manages piece creation and editing"""
-    def __init__(self, root):
+    def __init__(self, root, library = None):
         Controller.__init__(self, root)
+        self.library = library
 
     def run(self):
         self.frame.grid(sticky = tk.NW + tk.NE + tk.SW + tk.SE)
         
         self.buildMenu()
-        
-        self.frame.mainloop()
-
-    def protectStandardPieces(self):
-        """Prevent the 7 standart pieces from being deleted"""
-        customizedPieceSet = set(Piece.knownShapes) - set(Piece.standardPieces)
-        pieceList = Piece.standardPieces + list(customizedPieceSet)
-        for i in xrange(len(self.menu.deleteButtons) - 1, -1, -1):
-            if pieceList[i] in Piece.standardPieces:
-                self.menu.delete(self.menu.deleteButtons[i])
-                self.menu.deleteButtons.pop(i)
 
     def menuBindEvent(self):
         """Binds events for the basic piece editing menu"""
@@ -150,8 +167,7 @@ class PieceEditor(Controller):
                 "<Button-1>", self.toMainMenu)
         self.menu.tag_bind(self.menu.addPieceButton, \
                 "<Button-1>", self.showAddPieceMenu)
-        for deleteButton in self.menu.deleteButtons:
-            self.menu.tag_bind(deleteButton, "<Button-1>", self.deletePiece)
+        self.menu.tag_bind("delete", "<Button-1>", self.deletePiece)
 
     def addPieceMenuBindEvents(self):
         """Bind events for the piece creation interface"""
@@ -173,15 +189,12 @@ class PieceEditor(Controller):
 
     def deletePiece(self, event):
         """Deletes a user-created piece"""
-        customizedPieceSet = set(Piece.knownShapes) - set(Piece.standardPieces)
-        pieceList = Piece.standardPieces + list(customizedPieceSet)
         hh, uh = self.menu.headerHeight, self.menu.unitHeight
         i = int((self.menu.canvasy(event.y) - hh) / uh)
-        Piece.forgetPiece(pieceList[i])
-        self.menu.destroy()
-        self.vbar.destroy()
-
-        self.buildMenu()
+        if not 0 <= i < len(self.menu.names): return
+        Piece.forgetPiece(self.menu.names[i])
+        self.savePieces()
+        self.menu.removeUnit(i)
 
     def selectCell(self, event):
         """Changes the shape of the piece that the user is creating
@@ -220,12 +233,29 @@ class PieceEditor(Controller):
             shape = self.addPieceMenu.interpretedShape
             color = self.addPieceMenu.color
             name = str(shape)
-            Piece.learnPiece(name, shape, color)
+            try:
+                Piece.learnPiece(name, shape, color)
+            except ValueError:
+                # the palette is full: only colors in use are left
+                self.addPieceMenu.itemconfigure(self.addPieceMenu.warnings, \
+                        text = "There are too many colors already, " \
+                        "choose one used by another piece.", fill = "red")
+                return
+            self.savePieces()
             self.backToMenu(None)
         else:
             self.addPieceMenu.itemconfigure(\
                 self.addPieceMenu.warnings, fill = "red")
 
+    def savePieces(self):
+        """Writes the pieces to the library so they are kept next time"""
+        if self.library == None: return
+        try:
+            self.library.save()
+        except (IOError, OSError) as e:
+            sys.stderr.write("cannot save {0}: {1}\n".format(\
+                    self.library.path, e))
+
     def backToMenu(self, event):
         """Dismiss the piece creation interface
            and show the basic piece editor menu"""
@@ -240,14 +270,13 @@ class PieceEditor(Controller):
         self.vbar.pack(side = RIGHT, fill = Y)
         self.menu.config(yscrollcommand = self.vbar.set)
         self.menu.drawMenu()
-        self.protectStandardPieces()
         self.menuBindEvent()
         self.menu.pack()
 
     def toMainMenu(self, event):
         """Navigate back to the Main controller"""
         self.isActive = False
-        self.frame.quit()
+        self.switchController()
         self.frame.destroy()
         self.root.unbind("<Button-1>")
         self.root.unbind("<KeyPress>")
@@ -256,8 +285,13 @@ class PieceEditor(Controller):
 
 class Settings(Controller):
     """Controller that allows the user to
-       customize board size, piece rotation, and scoring settings
+       customize board size, piece rotation, scoring and piece order settings
     """
+    # board sizes offered; sizes past the regular ones make mega boards,
+    # shown through a viewport and exempt from the recommended ratio
+    regularRows, regularCols = list(xrange(9, 31)), list(xrange(6, 21))
+    megaRows, megaCols = [50, 100, 200, 500, 1000], [50, 100, 200]
+
     def __init__(self, root):
         Controller.__init__(self, root)
         self.rowsSet = StringVar()
@@ -265,14 +299,15 @@ class Settings(Controller):
         self.rotationDirectionSet = IntVar()
         self.scoringMechanismSet = StringVar()
         self.scoringLevelDependenceSet = IntVar()
+        self.pieceStrategySet = StringVar()
 
     def run(self):
         self.frame.grid(sticky = tk.NW + tk.NE + tk.SW + tk.SE)
         self.createRotationSettings()
         self.createBoardSizeSettings()
         self.createScoringSettings()
+        self.createPieceOrderSettings()
         self.createMainMenuButton()
-        self.frame.mainloop()
 
     def createMainMenuButton(self):
         """Creates the button that navigates to the Main controller"""
@@ -304,8 +339,8 @@ class Settings(Controller):
         """
         self.rowsSet.set(Rules.rows)
         self.colsSet.set(Rules.cols)
-        rowsOptionList = list(xrange(9, 31))
-        colsOptionList = list(xrange(6, 21))
+        rowsOptionList = Settings.regularRows + Settings.megaRows
+        colsOptionList = Settings.regularCols + Settings.megaCols
         self.boardSizeSettingsTitle = Label(self.frame, justify = tk.LEFT, \
                 text = """Choose the game board size.
 Recommended: c ≤ r ≤ 2c""")
@@ -345,6 +380,23 @@ Recommended: c ≤ r ≤ 2c""")
         if Rules.scoringLevelDependence == 1:
             self.scoringSettings[2].select()
 
+    def createPieceOrderSettings(self):
+        """Creates the interface that allow the user
+           to change how the next pieces are picked
+        """
+        self.pieceOrderSettingsTitle = Label(self.frame, justify = tk.LEFT, \
+                text = """Choose how pieces are picked.""")
+        self.pieceOrderSettings = (Radiobutton(self.frame, text = "random", \
+                variable = self.pieceStrategySet, value = "uniform"), \
+                Radiobutton(self.frame, text = "every piece once per round", \
+                variable = self.pieceStrategySet, value = "bag"))
+        self.pieceOrderSettingsTitle.grid(row = 0, column = 4, \
+                sticky = tk.W + tk.S)
+        self.pieceOrderSettings[0].grid(row = 1, column = 4, sticky = tk.W)
+        # a "weighted" strategy set in code selects neither and is kept
+        self.pieceStrategySet.set(Rules.pieceStrategy)
+        self.pieceOrderSettings[1].grid(row = 2, column = 4, sticky = tk.W)
+
     def updateRules(self):
         """Saves the changes that the user makes and updates the rules"""
         Rules.rows = int(self.rowsSet.get())
@@ -352,10 +404,13 @@ Recommended: c ≤ r ≤ 2c""")
         Rules.rotationDirection = self.rotationDirectionSet.get()
         Rules.scoringMechanism = self.scoringMechanismSet.get()
         Rules.scoringLevelDependence = self.scoringLevelDependenceSet.get()
+        Rules.pieceStrategy = self.pieceStrategySet.get()
 
     @property
     def boardSizeIsRecommended(self):
         """Returns whether the ratio between rows and cols is good"""
+        if int(self.rowsSet.get()) > Settings.regularRows[-1] or \
+           int(self.colsSet.get()) > Settings.regularCols[-1]: return True
         return int(self.rowsSet.get()) >= int(self.colsSet.get()) and \
                int(self.rowsSet.get()) <= int(self.colsSet.get()) * 2
 
@@ -365,7 +420,7 @@ Recommended: c ≤ r ≤ 2c""")
         if self.boardSizeIsRecommended:
             self.isActive = False
             self.updateRules()
-            self.frame.quit()
+            self.switchController()
             self.frame.destroy()
             self.root.unbind("<Button-1>")
             self.root.unbind("<KeyPress>")
@@ -376,15 +431,36 @@ Recommended: c ≤ r ≤ 2c""")
 
 class Game(Controller):
     """The controller that manages the game"""
+    # every game is recorded and saved here when it is over
+    replayFile = "lastgame.ttr"
+    # frame timings are saved here with F4, and shown every
+    # profileOverlayInterval seconds while the overlay is on
+    profileFile = "profile.json"
+    profileOverlayInterval = 0.5
+    # milliseconds before a held key repeats, and between repeats
+    autoShiftDelay = 170
+    autoRepeatRate = 50
+
     def __init__(self, root):
         Controller.__init__(self, root)
         self.root.resizable(width = 0, height = 0)
         self.gameIsOn = True
-        self.learnStandardPieces()
+        self.autoPlayer, self.autoPlaying = AutoPlayer(), False
+        self.recorder, self.replayPlayer = None, None
+        self.profiler, self.profileOverlayTime = None, 0
+        # gravity steps run on the scheduler; moves are played as soon as
+        # the events are handled, or every frame for repeats, and the
+        # board is redrawn at most once per frame
+        self.scheduler = Scheduler(self.root, self.tick, self.render, \
+                lambda: self.state.gravityDelay, poll = self.processInput)
+        self.keys = KeyRepeater(Game.autoShiftDelay, Game.autoRepeatRate)
+        self.inputPending, self.needsRedraw = False, False
+        self.lastRedrawTime = 0
 
     def run(self):
         self.frame = Frame(self.root)
-        self.board = Board(parent = self.frame)
+        self.state = self.newGameState()
+        self.board = Board(parent = self.frame, state = self.state)
         self.board.pack()
 
         self.frame.grid(sticky = tk.NW + tk.NE + tk.SE + tk.SW)
@@ -394,25 +470,6 @@ class Game(Controller):
         self.bindEvents()
 
         self.startGame()
-            
-        self.frame.mainloop()
-
-    def learnStandardPieces(self):
-        """Save the 7 standard pieces"""
-        Piece.learnPiece("iPiece", \
-                [[True, True, True, True]], "red")
-        Piece.learnPiece("jPiece", \
-                [[True, False, False], [True, True, True]], "yellow")
-        Piece.learnPiece("lPiece", \
-                [[False, False, True], [True, True, True]], "magenta")
-        Piece.learnPiece("oPiece", \
-                [[True, True], [True, True]], "pink")
-        Piece.learnPiece("sPiece", \
-                [[False, True, True], [True, True, False]], "cyan")
-        Piece.learnPiece("tPiece", \
-                [[False, True, False], [True, True, True]], "green")
-        Piece.learnPiece("zPiece", \
-                [[True, True, False], [False, True, True]], "orange")
 
     def bindEvents(self):
         self.board.tag_bind(self.board.pauseButton, "<Button-1>", self.pause)
@@ -422,116 +479,211 @@ class Game(Controller):
         self.board.tag_bind(self.board.helpButtonText, \
                 "<Button-1>", self.help)
         self.root.bind("<KeyPress>", self.keyPressed)
+        self.root.bind("<KeyRelease>", self.keyReleased)
+        self.root.bind("<FocusOut>", self.focusLost)
 
     def keyPressed(self, event):
         """Handles key presses"""
-        if event.keysym == "Left":
+        profiler = self.profiler
+        if profiler != None: profiler.begin("input")
+        if event.keysym == "Escape":
+            self.pause(event)
+        elif event.keysym == "F3":
+            self.toggleProfiler()
+        elif event.keysym == "F4":
+            self.dumpProfile()
+        elif self.replayPlayer != None:
+            pass
+        elif event.keysym == "a":
+            self.autoPlaying = not self.autoPlaying
+        elif event.keysym in Replay.moves:
+            self.keys.press(event.keysym)
+            if not self.inputPending:
+                self.inputPending = True
+                self.root.after_idle(self.processInputNow)
+        if profiler != None: profiler.end()
+
+    def keyReleased(self, event):
+        self.keys.release(event.keysym)
+
+    def focusLost(self, event):
+        self.keys.releaseAll()
+
+    def processInput(self):
+        """Plays the moves of the keys pressed and held since the last
+           call, in order"""
+        self.inputPending = False
+        moves = self.keys.poll()
+        if not moves or not self.gameIsOn: return
+        profiler = self.profiler
+        if profiler != None: profiler.begin("input")
+        for keysym in moves:
+            self.playMove(keysym)
+            if not self.gameIsOn: break
+        if profiler != None: profiler.end()
+
+    def processInputNow(self):
+        """Plays the pending moves once the events have been handled, and
+           redraws unless the board was drawn less than a frame ago"""
+        if not self.inputPending: return
+        self.processInput()
+        if self.needsRedraw and self.gameIsOn and time.time() - \
+                self.lastRedrawTime >= self.scheduler.frameDelay / 1000.:
+            self.needsRedraw = False
+            self.redrawAll()
+
+    def toggleProfiler(self):
+        """Starts timing frames and shows the timings over the board,
+           or stops and hides them"""
+        if self.profiler == None:
+            self.profiler = FrameProfiler()
+            self.board.drawProfileOverlay(self.profiler.overlayLines())
+            self.profileOverlayTime = time.time()
+        else:
+            self.profiler = None
+            self.board.hideProfileOverlay()
+
+    def dumpProfile(self, path = None):
+        """Saves the frame timings, if they are being taken"""
+        if self.profiler != None:
+            self.profiler.dump(path if path != None else Game.profileFile)
+
+    def endProfiledFrame(self):
+        """Records the frame that just ended and refreshes the overlay"""
+        self.profiler.endFrame(len(self.board.find_all()))
+        if time.time() - self.profileOverlayTime >= \
+                Game.profileOverlayInterval:
+            self.profileOverlayTime = time.time()
+            self.board.drawProfileOverlay(self.profiler.overlayLines())
+
+    def playMove(self, keysym):
+        """Plays and records the move bound to a key"""
+        if not self.gameIsOn or keysym not in Replay.moves: return
+        if keysym == "Left":
             self.moveFallingPiece(0, -1)
-            if self.gameIsOn: self.redrawAll()
-        elif event.keysym == "Right":
+        elif keysym == "Right":
             self.moveFallingPiece(0, 1)
-            if self.gameIsOn: self.redrawAll()
-        elif event.keysym == "Down":
+        elif keysym == "Down":
             self.moveFallingPiece(1, 0)
-            if self.gameIsOn: self.redrawAll()
-        elif event.keysym == "Up":
-            self.rotateFallingPiece(Rules.rotationDirection)
-            if self.gameIsOn: self.redrawAll()
-        elif event.keysym == "Escape":
-            self.pause(event)
-        elif event.keysym == "Return":
+        elif keysym == "Up":
+            self.rotateFallingPiece(self.state.rules.rotationDirection)
+        elif keysym == "Return":
             self.hardDrop()
+        self.needsRedraw = self.gameIsOn
+        self.recordMove(keysym)
 
-    def timerFired(self):
-        """Moves the falling piece 1 step down
-           and schedules itself for the next call
+    def recordMove(self, move):
+        """Records a move, and saves the recording once the game is over"""
+        self.recorder.record(move)
+        if self.state.isOver: self.recorder.save(Game.replayFile)
+
+    def watchReplay(self, replay):
+        """Makes the next game play a replay back instead, on its own
+           board size and rules; the current ones are left as they are.
         """
-        if self.gameIsOn:
-            self.moveFallingPiece(1, 0)
-            if self.gameIsOn: self.redrawAll()
-            delay = int(7500. / Rules.rows - self.board.level * 50)
-            if delay < 750. / Rules.rows: delay = int(delay = 750. / Rules.rows)
-            self.board.after(delay, self.timerFired)
-            self.frame.update()
-
-    def newFallingPiece(self):
-        """Creates a new falling piece.
-           Ends game if it cannot be legally created.
+        self.replayPlayer = ReplayPlayer(replay)
+
+    def playReplayTick(self):
+        """Plays the inputs of the next tick of the watched replay"""
+        if not self.replayPlayer.stepTick() or self.state.isOver:
+            self.endGame()
+
+    def newGameState(self):
+        """Returns the state of a new game, or of the watched replay
+           played back from its start"""
+        if self.replayPlayer != None:
+            self.replayPlayer = ReplayPlayer(self.replayPlayer.replay)
+            return self.replayPlayer.state
+        return GameState()
+
+    def playAutoMoves(self):
+        """Lets the computer play the falling piece with the same moves
+           a player would make"""
+        for keysym in self.autoPlayer.bestMoves(self.state):
+            self.playMove(keysym)
+
+    def tick(self):
+        """Moves the falling piece 1 step down.
+           The scheduler calls it once per gravity delay.
         """
         if not self.gameIsOn: return
-        pieceList = list(Piece.knownShapes)
-        self.board.fallingPiece = self.board.nextPiece
-        self.board.nextPiece = Piece(pieceList[ \
-            random.randint(0, len(pieceList) - 1)], Rules.cols)
-        if not self.board.isLegal:
-            self.endGame()
-        
+        profiler = self.profiler
+        if profiler != None: profiler.begin("simulation")
+        if self.replayPlayer != None:
+            self.playReplayTick()
+        else:
+            self.moveFallingPiece(1, 0)
+            self.recordMove("Gravity")
+            if self.gameIsOn and self.autoPlaying: self.playAutoMoves()
+        if profiler != None: profiler.end()
+        self.needsRedraw = self.gameIsOn
+
+    def render(self, stepFraction):
+        """Redraws the board once per frame if a step changed it.
+           The board draws whole cells, so stepFraction is not used.
+        """
+        profiler = self.profiler
+        if self.needsRedraw:
+            self.needsRedraw = False
+            self.redrawAll()
+            if profiler != None:
+                # flush the canvas now so that painting gets timed
+                profiler.begin("update")
+                self.board.update_idletasks()
+                profiler.end()
+        if profiler != None: self.endProfiledFrame()
+
     def moveFallingPiece(self, drow, dcol):
-        """Move the falling piece down. Creates a new falling piece if
-           the current one can't move or does not exist.
+        """Moves the falling piece on the game state.
+           Ends game if no new piece can be created.
         """
         if not self.gameIsOn: return
-        fallingPiece = self.board.fallingPiece
-        if fallingPiece == None:
-            self.newFallingPiece()
-            return
-        fallingPiece.position[0] += drow
-        fallingPiece.position[1] += dcol
-        if not self.board.isLegal:
-            fallingPiece.position[0] -= drow
-            fallingPiece.position[1] -= dcol
-            if drow == 1:
-                self.putPieceOnBoard()
-                self.removeFullRows()
-                self.newFallingPiece()
-                return False
-        else: return True
+        moved = self.state.moveFallingPiece(drow, dcol)
+        if self.state.isOver: self.endGame()
+        return moved
 
     def hardDrop(self):
         """Moves the falling piece down as far as possible"""
-        while self.moveFallingPiece(1, 0):
-            pass
-        if self.gameIsOn: self.redrawAll()
+        if not self.gameIsOn: return
+        self.state.hardDrop()
+        if self.state.isOver: self.endGame()
 
     def rotateFallingPiece(self, direction):
-        """Rotates the falling piece about its upperleft corner
-           by changing the orientation variable of the piece object
-        """
+        """Rotates the falling piece on the game state"""
         if not self.gameIsOn: return
-        initialOrientation = self.board.fallingPiece.orientation
-        self.board.fallingPiece.orientation = \
-                (initialOrientation + direction) % 4
-        if not self.board.isLegal:
-            self.board.fallingPiece.orientation = initialOrientation
-
-    def putPieceOnBoard(self):
-        """Put the falling piece on the board as it can't move down"""
-        for cell in self.board.fallingPieceCells:
-            self.board.colorContent[cell[0]][cell[1]] = \
-                    self.board.fallingPiece.color
+        self.state.rotateFallingPiece(direction)
         
     def redrawAll(self):
         """Redraws the game board"""
+        profiler = self.profiler
+        if profiler != None: profiler.begin("draw")
         self.board.drawGame()
+        self.lastRedrawTime = time.time()
+        if profiler != None: profiler.end()
 
     def startGame(self):
         """Starts the game by creating the falling piece and the next piece
            and starting the timer"""
-        pieceList = list(Piece.knownShapes)
-        self.board.nextPiece = Piece(pieceList[ \
-            random.randint(0, len(pieceList) - 1)], Rules.cols)
+        if self.replayPlayer == None:
+            self.state.start()
+            self.recorder = ReplayRecorder(self.state)
+        self.keys.reset()
         self.redrawAll()
-        self.frame.after(int(7500. / Rules.rows), self.timerFired())
+        self.scheduler.reset()
+        self.scheduler.start()
 
     def endGame(self):
         """Ends the game by unbinding all buttons and stopping the timer"""
         self.gameIsOn = False
+        self.scheduler.stop()
         self.board.drawGameOverMenu()
         self.board.tag_unbind(self.board.pauseButton, "<Button-1>")
         self.board.tag_unbind(self.board.pauseButtonText, "<Button-1>")
         self.board.tag_unbind(self.board.helpButton, "<Button-1>")
         self.board.tag_unbind(self.board.helpButtonText, "<Button-1>")
         self.root.unbind("<KeyPress>")
+        self.root.unbind("<KeyRelease>")
+        self.root.unbind("<FocusOut>")
         self.board.tag_bind(self.board.restartButton, \
                 "<Button-1>", self.restart)
         self.board.tag_bind(self.board.mainMenuButton, \
@@ -541,6 +693,7 @@ class Game(Controller):
         """Makes a pause by stopping the timer and shows the pause menu"""
         if self.gameIsOn:
             self.gameIsOn = False
+            self.scheduler.stop()
             self.board.drawPauseMenu()
             self.board.tag_bind(self.board.resumeButton, \
                     "<Button-1>", self.resume)
@@ -554,13 +707,15 @@ class Game(Controller):
         """Makes a pause by stopping the timer and shows the help menu"""
         if self.gameIsOn:
             self.gameIsOn = False
+            self.scheduler.stop()
             self.board.drawHelpMenu()
         else: self.resume(event)
 
     def resume(self, event):
-        """Resumes the game by calling the timerFired method"""
+        """Resumes the game by restarting the timer"""
         self.gameIsOn = True
-        self.timerFired()
+        self.redrawAll()
+        self.scheduler.start()
 
     def restart(self, event):
         """Restart the game by returning to the initial state"""
@@ -571,40 +726,27 @@ class Game(Controller):
         self.startGame()
 
     def resetBoard(self):
-        """Resets the board to the initial state"""
+        """Resets the board and the game state to the initial state"""
         self.board.destroy()
-        self.board = Board(parent = self.frame)
+        self.state = self.newGameState()
+        self.board = Board(parent = self.frame, state = self.state)
         self.board.pack()
 
-    def removeFullRows(self):
-        """Removes full rows and updates score and level"""
-        fullRowCount = 0
-        sm, sld = Rules.scoringMechanism, Rules.scoringLevelDependence
-        for i in xrange(len(self.board.colorContent)):
-            if self.board.emptyColor not in self.board.colorContent[i]:
-                fullRowCount += 1
-                self.board.colorContent[0] = \
-                        [self.board.emptyColor] * Rules.cols
-                for k in xrange(i, 0, -1):
-                    self.board.colorContent[k] = \
-                            copy.copy(self.board.colorContent[k - 1])
-        if fullRowCount != 0:
-            if sm == "Base-4 exponential": s = 4 ** (fullRowCount - 1)
-            elif sm == "Quadratic": s = fullRowCount ** 2
-            if sld == 1: s *= (self.board.level + 1)
-            self.board.score += s
-        self.board.fallingPiece = None
-        self.redrawAll()
-
     def toMainMenu(self, event):
         """Navigates back to the Main controller"""
         self.gameIsOn = False
+        self.scheduler.stop()
+        if self.replayPlayer != None:
+            self.replayPlayer.replay.forgetPieces()
+            self.replayPlayer = None
         self.resetBoard()
         self.isActive = False
-        self.frame.quit()
+        self.switchController()
         self.frame.destroy()
         self.root.unbind("<Button-1>")
         self.root.unbind("<KeyPress>")
+        self.root.unbind("<KeyRelease>")
+        self.root.unbind("<FocusOut>")
         self.gameIsOn = True
 
 class MainMenu(Canvas):
@@ -654,30 +796,127 @@ class MainMenu(Canvas):
     def createButtonText(self, x, y, text):
         return self.create_text(x, y, text = text, font = self.buttonFont)
 
+class PieceSprites:
+    """Thumbnails of pieces, drawn once into images shared by every view.
+       A thumbnail is kept for each shape, cell size and color, so
+       learning, forgetting or recoloring pieces never makes one wrong.
+       None is dropped while its Tk root lives: Tk deletes an image once
+       nothing refers to it, which would blank the canvas items still
+       showing it. Images belong to the root they were drawn for, so
+       each root has its own, forgotten with the root.
+    """
+    lineColor = "black"
+    # the images of every Tk root, by (shape, cell size, color)
+    images = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def get(widget, name, orientation, cellSize, color):
+        """Returns the PhotoImage of a piece with cells of cellSize
+           pixels outlined by cellSize / 15, as the board draws them,
+           for the Tk root of widget"""
+        root = widget._root()
+        images = PieceSprites.images.get(root)
+        if images == None: images = PieceSprites.images[root] = dict()
+        shape = Piece.knownRotations[name][orientation].shape
+        key = (shape, cellSize, color)
+        image = images.get(key)
+        if image == None:
+            image = images[key] = \
+                    PieceSprites.draw(root, shape, cellSize, color)
+        return image
+
+    @staticmethod
+    def forget(root):
+        """Drops the images of a Tk root, once it is destroyed"""
+        PieceSprites.images.pop(root, None)
+
+    @staticmethod
+    def draw(root, shape, cellSize, color):
+        """Returns a new PhotoImage of a shape, transparent around it"""
+        line = max(1, int(round(cellSize / 15.)))
+        edges = lambda k: int(round(k * cellSize))
+        image = PhotoImage(master = root, \
+                width = edges(len(shape[0])) + line, \
+                height = edges(len(shape)) + line)
+        for i in xrange(len(shape)):
+            for j in xrange(len(shape[0])):
+                if shape[i][j]:
+                    # neighbours share the outline between them
+                    x1, y1, x2, y2 = edges(j), edges(i), edges(j + 1), \
+                            edges(i + 1)
+                    # one pixel of data is tiled over the region
+                    image.put(((PieceSprites.lineColor,),), \
+                            to = (x1, y1, x2 + line, y2 + line))
+                    image.put(((color,),), to = (x1 + line, y1 + line, x2, y2))
+        return image
+
 class PiecesMenu(Canvas):
-    """The view that renders the Piece Editor controller's basic menu"""
+    """The view that renders the Piece Editor controller's basic menu.
+       Only the units in view, and bufferUnits around them, are drawn;
+       the items of the units scrolled out are reused for the new ones.
+    """
     def __init__(self, parent = None):
         self.headerHeight = 40
-        self.unitHeight, self.units = 80, len(Piece.knownShapes)
+        self.names = Piece.knownNames()
+        self.unitHeight, self.units = 80, len(self.names)
         self.displayUnits, self.unitWidth = 7, 400
+        self.bufferUnits = 2
         self.backgroundColor, self.lineColor = "white", "black"
         self.pieceCellSize = self.unitHeight / 4.
         Canvas.__init__(self, parent, background = self.backgroundColor, \
             height = self.headerHeight + self.unitHeight * self.displayUnits, \
-            width = self.unitWidth, scrollregion = (0, 0, self.unitWidth, \
-            self.headerHeight + self.unitHeight * self.units))
+            width = self.unitWidth, scrollregion = self.scrollRegion)
         self.lineWidth = self.pieceCellSize / 15
+        # row -> the PiecesMenuUnit showing it, and the units not in use
+        self.drawnUnits, self.freeUnits = {}, []
+        self.unitCount = 0
+
+    @property
+    def scrollRegion(self):
+        return (0, 0, self.unitWidth, \
+                self.headerHeight + self.unitHeight * self.units)
 
     def drawMenu(self):
         self.drawHeader()
-        unitRow = 0
-        self.deleteButtons = []
-        for name in Piece.standardPieces:
-            self.drawUnit(name, unitRow)
-            unitRow += 1
-        for name in set(Piece.knownShapes) - set(Piece.standardPieces):
-            self.drawUnit(name, unitRow)
-            unitRow += 1
+        self.drawVisibleUnits()
+
+    def yview(self, *args):
+        """Scrolls like Canvas.yview, then draws the units come in view"""
+        result = Canvas.yview(self, *args)
+        if args: self.drawVisibleUnits()
+        return result
+
+    def visibleRows(self):
+        """Returns the rows in view or within bufferUnits of it"""
+        top = self.canvasy(0) - self.headerHeight
+        bottom = top + self.headerHeight + \
+                self.unitHeight * self.displayUnits
+        first = max(0, int(top // self.unitHeight) - self.bufferUnits)
+        last = min(self.units, \
+                int(bottom // self.unitHeight) + 1 + self.bufferUnits)
+        return xrange(first, last)
+
+    def drawVisibleUnits(self):
+        """Draws the units come in view with the items of those gone"""
+        rows = self.visibleRows()
+        for row in list(self.drawnUnits):
+            if row not in rows:
+                self.hideUnit(self.drawnUnits.pop(row))
+        for row in rows:
+            if row not in self.drawnUnits: self.drawUnit(self.names[row], row)
+
+    def removeUnit(self, row):
+        """Removes the unit of a row; the units below move up by one"""
+        self.names.pop(row)
+        self.units -= 1
+        if row in self.drawnUnits:
+            self.hideUnit(self.drawnUnits.pop(row))
+        for below in sorted(r for r in self.drawnUnits if r > row):
+            unit = self.drawnUnits.pop(below)
+            self.move(unit.tag, 0, -self.unitHeight)
+            self.drawnUnits[below - 1] = unit
+        self.config(scrollregion = self.scrollRegion)
+        self.drawVisibleUnits()
 
     def drawHeader(self):
         hh = self.headerHeight
@@ -689,32 +928,56 @@ class PiecesMenu(Canvas):
         self.addPieceButton = self.create_text(x2, y2, \
                 text = "+", font = ("Helvetica", 26, "bold"), anchor = tk.E)
 
+    def newUnit(self):
+        """Returns a unit to draw in, reusing a hidden one if possible"""
+        if self.freeUnits: return self.freeUnits.pop()
+        tag = "unit{0}".format(self.unitCount)
+        self.unitCount += 1
+        lines = [self.create_line(0, 0, 0, 0, width = self.lineWidth, \
+                tags = tag) for k in xrange(2)]
+        deleteButton = self.create_text(0, 0, anchor = tk.E, text = "×", \
+                font = ("Helvetica", 20), tags = (tag, "delete"))
+        image = self.create_image(0, 0, anchor = tk.W, tags = tag)
+        return PiecesMenuUnit(tag, lines, deleteButton, image)
+
+    def hideUnit(self, unit):
+        self.itemconfigure(unit.tag, state = HIDDEN)
+        self.freeUnits.append(unit)
+
     def drawUnit(self, name, row):
+        unit = self.newUnit()
+        self.drawnUnits[row] = unit
         hh = self.headerHeight
-        self.create_line(0, hh + row * self.unitHeight, self.unitWidth, \
-                hh + row * self.unitHeight, width = self.lineWidth)
-        self.create_line(0, hh + (row + 1) * self.unitHeight, self.unitWidth, \
-                hh + (row + 1) * self.unitHeight, width = self.lineWidth)
-        shape = Piece.knownShapes[name]
-        color = Piece.knownColors[name]
-        size = self.pieceCellSize
-        xStart = 0.25 * self.unitHeight
-        yStart = hh + (row + 0.5) * self.unitHeight - len(shape) * size * 0.5
-        for i in xrange(len(shape)):
-            for j in xrange(len(shape[0])):
-                if shape[i][j]:
-                    self.create_rectangle(xStart + j * size, yStart + i * size,\
-                            xStart + (j + 1) * size, yStart + (i + 1) * size, \
-                            fill = color, width = self.lineWidth)
-        self.deleteButtons.append(\
-            self.create_text(self.unitWidth - 0.25 * self.unitHeight, \
-                hh + (row + 0.5) * self.unitHeight, anchor = tk.E, text = "×", \
-                    font = ("Helvetica", 20)))
+        for k in xrange(2):
+            self.coords(unit.lines[k], 0, hh + (row + k) * self.unitHeight, \
+                    self.unitWidth, hh + (row + k) * self.unitHeight)
+            self.itemconfigure(unit.lines[k], state = NORMAL)
+        self.coords(unit.image, 0.25 * self.unitHeight, \
+                hh + (row + 0.5) * self.unitHeight)
+        self.itemconfigure(unit.image, state = NORMAL, \
+                image = PieceSprites.get(self, name, 0, \
+                self.pieceCellSize, Piece.knownColors[name]))
+        # the standard pieces cannot be deleted
+        self.coords(unit.deleteButton, \
+                self.unitWidth - 0.25 * self.unitHeight, \
+                hh + (row + 0.5) * self.unitHeight)
+        self.itemconfigure(unit.deleteButton, state = HIDDEN \
+                if name in Piece.standardPieces else NORMAL)
+
+class PiecesMenuUnit:
+    """The canvas items of one unit of a PiecesMenu, all tagged tag"""
+    def __init__(self, tag, lines, deleteButton, image):
+        self.tag, self.lines, self.deleteButton = tag, lines, deleteButton
+        self.image = image
 
 class AddPieceMenu(Canvas):
     """The view that renders the piece creation interface"""
-    def __init__(self, parent = None):
-        self.cellSize, self.rows, self.cols, self.marginWidth = 60, 2, 4, 90
+    # whether a mirror image of a known piece counts as the same piece
+    mirrorsAreDuplicates = True
+
+    def __init__(self, parent = None, rows = 2, cols = 4):
+        self.cellSize, self.rows, self.cols, self.marginWidth = \
+                60, rows, cols, 90
         self.width = self.cellSize * self.cols + 2 * self.marginWidth
         self.height = self.cellSize * self.rows + 2 * self.marginWidth
         self.shape = [[False for j in xrange(self.cols)] \
@@ -728,28 +991,16 @@ class AddPieceMenu(Canvas):
     @property
     def interpretedShape(self):
         """Parse the user-created shape to the right format"""
-        result = copy.deepcopy(self.shape)
-        for i in xrange(len(result) - 1, -1, -1):
-            if True not in result[i]: result.pop(i)
-        for j in xrange(len(result[0]) - 1, -1, -1):
-            if True not in [result[i][j] for i in xrange(len(result))]:
-                for i in xrange(len(result)): result[i].pop(j)
-        return result
+        return Piece.trimShape(self.shape)
 
     @property
     def shapeIsRecommended(self):
         """Returns whether the user-created shape is recommended"""
         if sum([row.count(True) for row in self.shape]) < 3: return False
         shape = self.interpretedShape
-        for i in xrange(len(shape)):
-            for j in xrange(len(shape[0]) - 1):
-                if shape[i][j] and not (shape[i - 1][j] or shape[i][j + 1]):
-                    return False
-        for name in Piece.knownShapes:
-            if Piece.knownShapes[name] == shape or \
-               Piece.knownShapes[name] == list(reversed(shape)):
-                return False
-        return True
+        if not Piece.isConnected(shape): return False
+        return Piece.findShape(shape, AddPieceMenu.mirrorsAreDuplicates) \
+                == None
 
     def drawMenu(self):
         self.drawCells()
@@ -781,7 +1032,8 @@ class AddPieceMenu(Canvas):
                 font = self.font)
     
     def drawInstructions(self):
-        x, y = self.width * 0.5, self.marginWidth + 2 * self.cellSize + 30
+        x, y = self.width * 0.5, \
+                self.marginWidth + self.rows * self.cellSize + 30
         self.instruction = self.create_text(x, y, text = \
 """Click on the blocks to create piece. Right-click to choose color.""", \
 font = ("Helvetica", 12))
@@ -790,104 +1042,221 @@ font = ("Helvetica", 12))
 existing pieces.""", font = ("Helvetica", 10))
         
 class Board(Canvas):
-    """The view that renders the game"""
-    def __init__(self, parent = None):
-        rows, cols, cellSize = Rules.rows, Rules.cols, Rules.cellSize()
+    """The view that renders the game state.
+       The board is laid out for the rules of its state. Boards too big
+       to show at Rules.minCellSize are shown through a viewport of
+       Rules.viewSize() cells that follows the falling piece.
+    """
+    # rows and cols kept between the falling piece and the viewport edge
+    viewMargin = 4
+
+    def __init__(self, parent = None, state = None):
+        self.rules = state.rules if state != None else Rules
+        self.cellSize = cellSize = Rules.cellSize(self.rules)
+        self.viewRows, self.viewCols = Rules.viewSize(self.rules)
+        self.viewTop, self.viewLeft = 0, 0
         marginWidth = Rules.marginWidth
-        self.masterWidth = cols * cellSize + 2 * marginWidth
-        self.masterHeight = rows * cellSize + 4 * marginWidth
+        self.masterWidth = self.viewCols * cellSize + 2 * marginWidth
+        self.masterHeight = self.viewRows * cellSize + 4 * marginWidth
         Canvas.__init__(self, parent, \
                 width = self.masterWidth, height = self.masterHeight)
-        self.background, self.lineColor, self.score = "orange", "black", 0
-        self.lineWidth, self.emptyColor = cellSize / 15, "blue"
-        self.colorContent = [[self.emptyColor for j in xrange(cols)] \
-                for i in xrange(rows)]
-        self.fallingPiece, self.nextPiece = None, None
+        self.background, self.lineColor = "orange", "black"
+        self.lineWidth = cellSize / 15
+        self.state = state
         self.buttonColor = "gray"
+        self.cells = None
+        self.profileText, self.profileBackground = None, None
 
-    @property
-    def level(self):
-        """Returns the user's current level"""
-        return 0 if self.score / 5 == 0 else int(math.log(self.score / 5., 2))
-    
     def drawGame(self):
-        for tag in self.find_all():
-            if tag != self.pauseButton and tag != self.pauseButtonText\
-               and tag != self.helpButton and tag != self.helpButtonText:
-                self.delete(tag)
-        self.create_rectangle(0, 0, self.masterWidth, \
-                self.masterHeight, width = 0, \
-                fill = self.background)
-        self.drawBoard()
-        self.drawFallingPiece()
+        """Updates the canvas items that changed since the last frame"""
+        self.delete("menu")
+        if self.cells == None: self.createGameItems()
+        fallingPieceCells = self.state.fallingPieceCells
+        self.drawBoard(fallingPieceCells)
+        self.drawFallingPiece(fallingPieceCells)
+        self.drawGhostPiece(fallingPieceCells)
         self.drawNextPiece()
         self.drawScore()
         self.drawLevel()
+
+    def createGameItems(self):
+        """Creates the background, the grid of cells and the texts once.
+           Later frames only reconfigure them.
+        """
+        rows, cols, cellSize = self.viewRows, self.viewCols, \
+                self.cellSize
+        startX, startY = Rules.marginWidth, Rules.marginWidth * 3
+        emptyColor = self.state.emptyColor
+        self.create_rectangle(0, 0, self.masterWidth, \
+                self.masterHeight, width = 0, \
+                fill = self.background)
+        self.cells = [[self.create_rectangle(startX + j * cellSize, \
+                startY + i * cellSize, \
+                startX + (j + 1) * cellSize, \
+                startY + (i + 1) * cellSize, \
+                outline = self.lineColor, \
+                width = self.lineWidth, \
+                fill = emptyColor) for j in xrange(cols)] \
+                for i in xrange(rows)]
+        self.cellFills = [[emptyColor] * cols for i in xrange(rows)]
+        # the part of every row in view last drawn, None to redraw it
+        self.drawnRows = [None] * rows
+        self.drawnFallingPieceCells = []
+        # outlines of the cells the falling piece would land on
+        self.ghostItems, self.drawnGhost = [], None
+        # the preview of the next piece is centered above the board
+        self.nextPieceImage = self.create_image(Rules.marginWidth + \
+                self.viewCols / 2. * self.cellSize, \
+                1.5 * Rules.marginWidth, state = HIDDEN)
+        self.drawnNextPiece = None
+        self.scoreText = self.create_text(Rules.marginWidth, \
+                Rules.marginWidth * 0.75, anchor = tk.NW, text = "")
+        self.levelText = self.create_text(Rules.marginWidth, \
+                Rules.marginWidth * 1.5, anchor = tk.NW, text = "")
+        self.drawnScore, self.drawnLevel = None, None
         self.tag_raise(self.pauseButton)
         self.tag_raise(self.pauseButtonText)
         self.tag_raise(self.helpButton)
         self.tag_raise(self.helpButtonText)
-        
-    def drawBoard(self):
-        for i in xrange(len(self.colorContent)):
-            for j in xrange(len(self.colorContent[0])):
-                self.create_rectangle(Rules.marginWidth + j * Rules.cellSize(),\
-                        Rules.marginWidth * 3 + i * Rules.cellSize(), \
-                        Rules.marginWidth + (j + 1) * Rules.cellSize(), \
-                        Rules.marginWidth * 3 + (i + 1) * Rules.cellSize(), \
-                        outline = self.lineColor, \
-                        width = self.lineWidth, \
-                        fill = self.colorContent[i][j])
 
+    def fillCell(self, row, col, color):
+        """Recolors the cell of a board row and col, unless it already
+           has the color or is out of view"""
+        row, col = row - self.viewTop, col - self.viewLeft
+        if 0 <= row < self.viewRows and 0 <= col < self.viewCols and \
+                self.cellFills[row][col] != color:
+            self.cellFills[row][col] = color
+            self.itemconfigure(self.cells[row][col], fill = color)
+
+    def followFallingPiece(self):
+        """Scrolls the viewport to keep viewMargin rows and cols around
+           the falling piece, as far as the board goes.
+           The whole view is redrawn when it moves.
+        """
+        piece = self.state.fallingPiece
+        if piece == None: return
+        rotation = piece.rotation
+        row, col = piece.position
+        top = Board.scrollTo(self.viewTop, self.viewRows, self.state.rows, \
+                row, row + rotation.height)
+        left = Board.scrollTo(self.viewLeft, self.viewCols, \
+                self.state.cols, col + rotation.left, col + rotation.right + 1)
+        if (top, left) != (self.viewTop, self.viewLeft):
+            self.viewTop, self.viewLeft = top, left
+            self.drawnRows = [None] * self.viewRows
+
+    @staticmethod
+    def scrollTo(start, length, total, first, end):
+        """Returns the start of a view of length out of total that is
+           closest to start and shows first to end with a margin"""
+        margin = min(Board.viewMargin, (length - (end - first)) // 2)
+        start = min(start, first - margin)
+        start = max(start, end + margin - length)
+        return max(0, min(start, total - length))
+
+    def drawBoard(self, fallingPieceCells):
+        """Recolors the cells of the rows that changed on the board
+           and the cells the falling piece left
+        """
+        self.followFallingPiece()
+        palette, cellColors = self.state.palette, self.state.cellColors
+        dirtyCells = self.drawnFallingPieceCells
+        top, left, cols = self.viewTop, self.viewLeft, self.viewCols
+        for k in xrange(self.viewRows):
+            i = top + k
+            colors = cellColors[i][left:left + cols]
+            if colors != self.drawnRows[k]:
+                self.drawnRows[k] = colors
+                dirtyCells.extend([(i, j) for j in xrange(left, left + cols)])
+        for cell in dirtyCells:
+            if cell not in fallingPieceCells:
+                self.fillCell(cell[0], cell[1], \
+                        palette[cellColors[cell[0]][cell[1]]])
                     
-    def drawFallingPiece(self):
-        fallingPieceCells = self.fallingPieceCells
-        startX = Rules.marginWidth
-        startY = Rules.marginWidth * 3
-        cellSize = Rules.cellSize()
+    def drawFallingPiece(self, fallingPieceCells):
+        self.drawnFallingPieceCells = fallingPieceCells
+        if self.state.fallingPiece == None: return
+        color = self.state.fallingPiece.color
         for cell in fallingPieceCells:
-            self.create_rectangle(startX + cell[1] * cellSize, \
-                    startY + cell[0] * cellSize, \
-                    startX + (cell[1] + 1) * cellSize, \
-                    startY + (cell[0] + 1) * cellSize, \
-                    outline = self.lineColor, \
-                    width = self.lineWidth, \
-                    fill = self.fallingPiece.color)
+            self.fillCell(cell[0], cell[1], color)
 
-    def drawNextPiece(self):
-        if self.nextPiece == None: return
-        shape = self.nextPiece.shape
-        scale = 0.75 * Rules.marginWidth / Rules.cellSize()
-        scaledLineWidth = self.lineWidth * scale
-        scaledCellSize = Rules.cellSize() * scale
-        pieceHeight = len(shape) * scaledCellSize
-        pieceWidth = len(shape[0]) * scaledCellSize
-        startX = Rules.marginWidth + Rules.cols / 2. \
-                 * Rules.cellSize() - 0.5 * pieceWidth
-        startY = 1.5 * Rules.marginWidth - 0.5 * pieceHeight
-        for i in xrange(len(shape)):
-            for j in xrange(len(shape[0])):
-                if shape[i][j] == True:
-                    self.create_rectangle(\
-                        startX + j * scaledCellSize, \
-                        startY + i * scaledCellSize,\
-                        startX + (j + 1) * scaledCellSize, \
-                        startY + (i + 1) * scaledCellSize, \
-                        outline = self.lineColor, width = scaledLineWidth, \
-                        fill = self.nextPiece.color)
+    def drawGhostPiece(self, fallingPieceCells):
+        """Outlines where the falling piece would land if dropped.
+           The items only move when the landing place or the view does.
+        """
+        piece = self.state.fallingPiece
+        ghost = None
+        if piece != None and not self.state.isOver:
+            distance = self.state.dropDistance
+            ghost = (self.viewTop, self.viewLeft, piece.color, \
+                    tuple((i + distance, j) for i, j in fallingPieceCells))
+        if ghost == self.drawnGhost: return
+        self.drawnGhost = ghost
+        cells = ghost[3] if ghost != None else ()
+        cellSize = self.cellSize
+        startX, startY = Rules.marginWidth, Rules.marginWidth * 3
+        while len(self.ghostItems) < len(cells):
+            self.ghostItems.append(self.create_rectangle(0, 0, 0, 0, \
+                    width = 2 * self.lineWidth, state = HIDDEN))
+        for k in xrange(len(self.ghostItems)):
+            item = self.ghostItems[k]
+            if k >= len(cells):
+                self.itemconfigure(item, state = HIDDEN)
+                continue
+            i, j = cells[k][0] - self.viewTop, cells[k][1] - self.viewLeft
+            if not (0 <= i < self.viewRows and 0 <= j < self.viewCols):
+                self.itemconfigure(item, state = HIDDEN)
+                continue
+            self.coords(item, startX + j * cellSize, startY + i * cellSize, \
+                    startX + (j + 1) * cellSize, startY + (i + 1) * cellSize)
+            self.itemconfigure(item, outline = ghost[2], state = NORMAL)
 
+    def drawNextPiece(self):
+        nextPiece = self.state.nextPiece
+        if nextPiece is self.drawnNextPiece: return
+        self.drawnNextPiece = nextPiece
+        if nextPiece == None:
+            self.itemconfigure(self.nextPieceImage, state = HIDDEN)
+            return
+        # the preview cells are scaled to 3/4 of the margin
+        self.itemconfigure(self.nextPieceImage, state = NORMAL, \
+                image = PieceSprites.get(self, nextPiece.name, \
+                nextPiece.orientation, 0.75 * Rules.marginWidth, \
+                nextPiece.color))
 
     def drawScore(self):
-        self.create_text(Rules.marginWidth, Rules.marginWidth * 0.75, \
-                anchor = tk.NW, text = "Score: {0}".format(self.score))
+        if self.state.score != self.drawnScore:
+            self.drawnScore = self.state.score
+            self.itemconfigure(self.scoreText, \
+                    text = "Score: {0}".format(self.drawnScore))
 
     def drawLevel(self):
-        self.create_text(Rules.marginWidth, Rules.marginWidth * 1.5, \
-                anchor = tk.NW, text = "Level: {0}".format(self.level))
+        if self.state.level != self.drawnLevel:
+            self.drawnLevel = self.state.level
+            self.itemconfigure(self.levelText, \
+                    text = "Level: {0}".format(self.drawnLevel))
+
+    def drawProfileOverlay(self, lines):
+        """Shows lines of frame timings over the top left of the board"""
+        if self.profileText == None:
+            self.profileBackground = self.create_rectangle(0, 0, 0, 0, \
+                    width = 0, fill = "black", tags = "profile")
+            self.profileText = self.create_text(Rules.marginWidth + 5, \
+                    Rules.marginWidth * 3 + 5, anchor = tk.NW, \
+                    fill = "white", font = ("Courier", 9), tags = "profile")
+        self.itemconfigure(self.profileText, text = "\n".join(lines))
+        x0, y0, x1, y1 = self.bbox(self.profileText)
+        self.coords(self.profileBackground, x0 - 3, y0 - 3, x1 + 3, y1 + 3)
+        self.tag_raise("profile")
+
+    def hideProfileOverlay(self):
+        self.delete("profile")
+        self.profileText, self.profileBackground = None, None
 
     def drawButtons(self):
         buttonRadius = Rules.marginWidth / 2.
-        x = Rules.marginWidth + Rules.cols * Rules.cellSize() - buttonRadius
+        x = Rules.marginWidth + self.viewCols * self.cellSize - \
+                buttonRadius
         y = 1.5 * Rules.marginWidth
         self.pauseButton = self.create_rectangle(x - buttonRadius, \
                 y - buttonRadius, x + buttonRadius, y + buttonRadius, \
@@ -901,209 +1270,105 @@ class Board(Canvas):
                 y, text = "?", font = ("Helvetica", int(1.5 * buttonRadius)))
 
     def drawPauseMenu(self):
-        x = Rules.marginWidth + 0.5 * Rules.cols * Rules.cellSize()
-        y = 2 * Rules.marginWidth + 0.5 * Rules.rows * Rules.cellSize()
+        x = Rules.marginWidth + 0.5 * self.viewCols * self.cellSize
+        y = 2 * Rules.marginWidth + 0.5 * self.viewRows * self.cellSize
         menuWidth, menuHeight = 175, 262.5
         self.pauseMenu = self.create_rectangle(\
                 x - menuWidth * 0.5, y - menuHeight * 0.5, \
                 x + menuWidth * 0.5, y + menuHeight * 0.5,\
                 outline = self.lineColor, width = self.lineWidth, \
-                fill = self.buttonColor)
+                fill = self.buttonColor, tags = "menu")
         self.resumeButton = self.create_text(x, y - menuHeight * 0.25, \
                 text = "RESUME", font = ("Helvetica", \
                 int(menuWidth / 10.5625 if menuWidth < menuHeight else \
-                menuHeight / 10)))
+                menuHeight / 10)), tags = "menu")
         self.restartButton = self.create_text(x, y, text = "RESTART", \
                 font = ("Helvetica", int(menuWidth / 10.5625 \
-                if menuWidth < menuHeight else menuHeight / 10)))
+                if menuWidth < menuHeight else menuHeight / 10)), \
+                tags = "menu")
         self.mainMenuButton = self.create_text(x, y + menuHeight * 0.25, \
                 text = "MAIN MENU", font = ("Helvetica", \
                 int(menuWidth / 10.5625 if menuWidth < menuHeight else \
-                menuHeight / 10)))
+                menuHeight / 10)), tags = "menu")
 
     def drawGameOverMenu(self):
-        x = Rules.marginWidth + 0.5 * Rules.cols * Rules.cellSize()
-        y = 2 * Rules.marginWidth + 0.5 * Rules.rows * Rules.cellSize()
+        x = Rules.marginWidth + 0.5 * self.viewCols * self.cellSize
+        y = 2 * Rules.marginWidth + 0.5 * self.viewRows * self.cellSize
         menuWidth, menuHeight = 175, 262.5
         self.gameOverMenu = self.create_rectangle(\
                 x - menuWidth * 0.5, y - menuHeight * 0.5, \
                 x + menuWidth * 0.5, y + menuHeight * 0.5, \
                 outline = self.lineColor, width = self.lineWidth, \
-                fill = self.buttonColor)
+                fill = self.buttonColor, tags = "menu")
         self.create_text(x, y - menuHeight * 0.5 + menuHeight / 13.125, \
                 text = "GAME OVER", font = ("Helvetica", \
                 int(menuWidth / 8.75 if menuWidth < menuHeight else \
-                menuHeight / 7)), anchor = tk.N, fill = "red")
+                menuHeight / 7)), anchor = tk.N, fill = "red", \
+                tags = "menu")
         self.restartButton = self.create_text(x, y - menuHeight * 0.125, \
                 text = "RESTART", font = ("Helvetica", \
                 int(menuWidth / 10.5625 if menuWidth < menuHeight else \
-                menuHeight / 10)))
+                menuHeight / 10)), tags = "menu")
         self.mainMenuButton = self.create_text(x, y + menuHeight * 0.125, \
                 text = "MAIN MENU", font = ("Helvetica", \
                 int(menuWidth / 10.5625 if menuWidth < menuHeight else \
-                menuHeight / 10)))
+                menuHeight / 10)), tags = "menu")
 
     def drawHelpMenu(self):
-        x = Rules.marginWidth + 0.5 * Rules.cols * Rules.cellSize()
-        y = 2 * Rules.marginWidth + 0.5 * Rules.rows * Rules.cellSize()
-        menuWidth, menuHeight = 300, 250
+        x = Rules.marginWidth + 0.5 * self.viewCols * self.cellSize
+        y = 2 * Rules.marginWidth + 0.5 * self.viewRows * self.cellSize
+        menuWidth, menuHeight = 300, 340
         self.helpMenu = self.create_rectangle(\
                 x - menuWidth * 0.5, y - menuHeight * 0.5, \
                 x + menuWidth * 0.5, y + menuHeight * 0.5, \
                 outline = self.lineColor, width = self.lineWidth, \
-                fill = self.buttonColor)
+                fill = self.buttonColor, tags = "menu")
         self.create_text(x, y, text = \
 """\
 - Press "Left"/"Right"/"Down" to move piece.
 
 - Press "Up" to rotate piece.
 
-- Press "Enter" to play hard drop.
+- Press "Enter" to play hard drop; the
+outline shows where the piece lands.
 
 - Press "esc" to pause/resume.
 
+- Press "a" to let the computer play.
+
+- Press "F3" to show frame timings
+and "F4" to save them.
+
 - Go to Main Menu > Settings to change
-board size, rotating direction of pieces
-and scoring mechanism.
+board size, rotating direction of pieces,
+scoring mechanism and piece order.
 
 - Go to Main Menu > Piece Editor to create
 pieces (user-created pieces can be deleted).\
-""")        
-
-    @property
-    def fallingPieceCells(self):
-        """Returns the indexes of cells occupied by the falling piece"""
-        fallingPieceCells = []
-        if self.fallingPiece == None: return fallingPieceCells
-        shape = self.fallingPiece.shape
-        position = self.fallingPiece.position
-        for i in xrange(len(shape)):
-            for j in xrange(len(shape[0])):
-                if shape[i][j] == True:
-                    fallingPieceCells.append((i + position[0], j + position[1]))
-        return fallingPieceCells
-
-    @property
-    def isLegal(self):
-        """Returns whether the falling piece does not overlap
-           with pieces already put on the board"""
-        fallingPieceCells = self.fallingPieceCells
-        for cell in fallingPieceCells:
-            if cell[0] >= Rules.rows or cell[1] < 0 or cell[1] >= Rules.cols:
-                return False
-            if self.colorContent[cell[0]][cell[1]] != self.emptyColor:
-                return False
-        return True
-        
-class Piece:
-    """Class that stores properties of piece instants and
-       manages the piece database"""
-    knownShapes = dict()
-    knownColors = dict()
-    knownShortcuts = dict()
-    standardPieces = \
-        ["iPiece", "jPiece", "lPiece", "oPiece", "sPiece", "tPiece", "zPiece"]
-
-    def __str__(self):
-        return """Piece name: {0};
-Piece color: {1};
-Piece position: {2};
-Piece shape: {3}.""".format(self.name, self.color, self.position, self.shape)
-
-    def __init__(self, name, boardCols):
-        self.name = name
-        self._shape = Piece.knownShapes[name]
-        self.color = Piece.knownColors[name]
-        self.orientation = 0
-        
-        self.position = [0, boardCols / 2 - len(self._shape[0]) / 2]
-
-    @staticmethod
-    def learnPiece(name, shape, color):
-        """Add a piece to the piece database"""
-        Piece.knownShapes[name] = shape
-        Piece.knownColors[name] = color
-
-    @staticmethod
-    def forgetPiece(name):
-        """Removes a piece from the piece database"""
-        Piece.knownShapes.pop(name)
-        Piece.knownColors.pop(name)
-
-    @property
-    def shape(self):
-        """Returns the piece shape under global coordinate
-           given the piece's orientation
-        """
-        if self.orientation == 0:
-            return self._shape
-        elif self.orientation == 1:
-            return self.getShapeCase1()
-        elif self.orientation == 2:
-            return self.getShapeCase2()
-        elif self.orientation == 3:
-            return self.getShapeCase3()
-        else:
-            return self._shape
-
-    def getShapeCase1(self):
-        """Returns the piece shape under global coordinate when the piece
-           is 90 degrees clockwise from the initial state
-        """
-        result = []
-        for j in xrange(len(self._shape[0])):
-            subResult = []
-            for i in xrange(len(self._shape) - 1, -1, -1):
-                subResult.append(self._shape[i][j])
-            result.append(subResult)
-        return result
-
-    def getShapeCase2(self):
-        """Returns the piece shape under global coordinate when the piece
-           is 180 degrees clockwise from the initial state
-        """
-        result = []
-        for i in xrange(len(self._shape) - 1, -1, -1):
-            subResult = []
-            for j in xrange(len(self._shape[0]) - 1, -1, -1):
-                subResult.append(self._shape[i][j])
-            result.append(subResult)
-        return result
-
-    def getShapeCase3(self):
-        """Returns the piece shape under global coordinate when the piece
-           is 90 degrees counterclockwise from the initial state
-        """
-        result = []
-        for j in xrange(len(self._shape[0]) - 1, -1, -1):
-            subResult = []
-            for i in xrange(len(self._shape)):
-                subResult.append(self._shape[i][j])
-            result.append(subResult)
-        return result
+""", tags = "menu")
 
 class Test:
 
     timesOfMovePiece = 0
     
     @staticmethod
-    def testlearnPiece(name, board):
+    def testlearnPiece(name, state):
         print "--------------------testing learnPiece"
         print "sPiece"
-        sPiece = Piece("sPiece", board.cols)
+        sPiece = Piece("sPiece", state.cols)
         print "\t", sPiece.shape, sPiece.color
         print name
-        specifiedPiece = Piece(name, board.cols)
+        specifiedPiece = Piece(name, state.cols)
         print "\t", specifiedPiece.shape, specifiedPiece.color
         print "--------------------test end\n"
 
     @staticmethod
     def testDrawBoard(application, rows, cols):
         print "--------------------testing drawBoard"
-        application.board.colorContent[0][0] = "red"
-        application.board.colorContent[0][cols - 1] = "white"
-        application.board.colorContent[rows - 1][0] = "green"
-        application.board.colorContent[rows - 1][cols - 1] = "gray"
+        application.state.setCell(0, 0, "red")
+        application.state.setCell(0, cols - 1, "white")
+        application.state.setCell(rows - 1, 0, "green")
+        application.state.setCell(rows - 1, cols - 1, "gray")
         print "--------------------test end\n"
 
     @staticmethod
@@ -1114,21 +1379,23 @@ class Test:
         print "--------------------test end\n"
 
     @staticmethod
-    def testNewFallingPiece(board):
+    def testNewFallingPiece(state):
         print "--------------------testing newFallingPiece"
         print "New piece instantiated."
-        print board.fallingPiece
-        print board.fallingPieceCells
+        print state.fallingPiece
+        print state.fallingPieceCells
         print "--------------------test end\n"
 
     @staticmethod
     def testDrawFallingPiece(application):
         print "--------------------testing drawFallingPiece"
-        application.newFallingPiece()
+        application.state.newFallingPiece()
         application.redrawAll()
         print "--------------------test end\n"
 
 
 # The run method in Application has no parameter.
+# To watch a replay, pass its file: python tetris_bonus.py lastgame.ttr
 # To change the board size, go to Main Menu > Settings.
-Application().run()
+if __name__ == "__main__":
+    Application(sys.argv[1] if len(sys.argv) > 1 else None).run()
@@ -0,0 +1,865 @@
+"""Headless core of the game: rules, the piece database and the game state.
+
+Nothing in here depends on Tkinter, so the game can be simulated without
+a display by bots, tests and batch jobs.
+"""
+import random
+import math
+import collections
+import bisect
+import array
+import hashlib
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class Rules:
+    """ Defines basic Rules of the game
+    """
+    # not customizable
+    defaultRows = 15
+    defaultCols = 10
+    defaultCellSize = 35
+    marginWidth = 30
+    # cells never get smaller; bigger boards are seen through a viewport
+    minCellSize = 12
+    # taller boards fall as fast as boards of this many rows
+    maxGravityRows = 30
+
+    # customizable
+    rows = 15
+    cols = 10
+    rotationDirection = -1
+    scoringMechanism = "Quadratic"
+    scoringLevelDependence = 0
+    # "uniform", "bag" or "weighted"; see PieceGenerator
+    pieceStrategy = "uniform"
+    pieceWeights = None
+
+    @staticmethod
+    def cellSize(rules = None):
+        """Returns the cell size that fits the number of rows and cols of
+           rules, the current ones by default, or minCellSize if that is
+           smaller
+        """
+        if rules == None: rules = Rules
+        size = float(Rules.defaultCellSize) * Rules.defaultRows / rules.rows \
+            if float(Rules.defaultRows) / rules.rows < \
+            float(Rules.defaultCols) / rules.cols else \
+            float(Rules.defaultCellSize) * Rules.defaultCols / rules.cols
+        return max(size, float(Rules.minCellSize))
+
+    @staticmethod
+    def viewSize(rules = None):
+        """Returns the number of rows and cols of rules shown at once, all
+           of them unless the cells would be smaller than minCellSize"""
+        if rules == None: rules = Rules
+        cellSize = Rules.cellSize(rules)
+        # the epsilon keeps the rounding of cellSize from losing a row
+        return (min(rules.rows, int(Rules.defaultRows * \
+                Rules.defaultCellSize / cellSize + 1e-6)), \
+                min(rules.cols, int(Rules.defaultCols * \
+                Rules.defaultCellSize / cellSize + 1e-6)))
+
+class PieceGenerator(object):
+    """Deterministic stream of piece indexes into names, drawn from a seed.
+       "uniform" picks every piece independently, "bag" deals every piece
+       once per round in a shuffled order and "weighted" picks pieces in
+       proportion to weights, a dict from name to weight (default 1).
+       Indexes are generated a block at a time and kept, so reading any
+       position already generated is O(1). The sequence only depends on
+       the names, the seed, the strategy and the weights, so states that
+       share a generator or use equal ones see the same pieces.
+    """
+    __slots__ = ("names", "seed", "strategy", "weights", \
+            "cumulativeWeights", "blockSize", "random", "indexes")
+    strategies = ("uniform", "bag", "weighted")
+
+    def __init__(self, names, seed, strategy = "uniform", weights = None, \
+            blockSize = 256):
+        if strategy not in PieceGenerator.strategies:
+            raise ValueError("unknown piece strategy {0}".format(strategy))
+        if len(names) == 0:
+            raise ValueError("no pieces to draw from")
+        self.names = list(names)
+        self.seed, self.strategy = seed, strategy
+        self.weights = [1. if weights == None else \
+                float(weights.get(name, 1)) for name in self.names]
+        self.cumulativeWeights = []
+        total = 0.
+        for weight in self.weights:
+            total += weight
+            self.cumulativeWeights.append(total)
+        if strategy == "weighted" and total <= 0:
+            raise ValueError("piece weights must have a positive sum")
+        self.blockSize = max(blockSize, len(self.names))
+        self.random = random.Random(seed)
+        self.indexes = array.array("H")
+
+    def generateBlock(self):
+        """Appends the next block of indexes to the sequence"""
+        count, draw = len(self.names), self.random.random
+        if self.strategy == "bag":
+            for i in xrange(self.blockSize // count):
+                # random.shuffle draws differently across Python versions
+                bag = list(xrange(count))
+                for j in xrange(count - 1, 0, -1):
+                    k = int(draw() * (j + 1))
+                    bag[j], bag[k] = bag[k], bag[j]
+                self.indexes.extend(bag)
+        elif self.strategy == "weighted":
+            cumulative = self.cumulativeWeights
+            total = cumulative[-1]
+            self.indexes.extend([min(bisect.bisect_right(cumulative, \
+                    draw() * total), count - 1) \
+                    for i in xrange(self.blockSize)])
+        else:
+            self.indexes.extend([int(draw() * count) \
+                    for i in xrange(self.blockSize)])
+
+    def indexAt(self, position):
+        """Returns the index of the piece drawn at a position"""
+        while position >= len(self.indexes):
+            self.generateBlock()
+        return self.indexes[position]
+
+    def nameAt(self, position):
+        """Returns the name of the piece drawn at a position"""
+        return self.names[self.indexAt(position)]
+
+    def indexesAt(self, position, count):
+        """Returns the indexes of count pieces from a position on"""
+        self.indexAt(position + count - 1)
+        return self.indexes[position:position + count]
+
+class Zobrist(object):
+    """Hashing of boards, kept up to date as cells change.
+       Every row index has a random 64-bit key, mixed with the bitmask
+       of the row; the hash of a board is the xor of its rows, empty
+       rows adding nothing. A changed row is xored out with its old mask
+       and in with its new one; rows that move, when full rows are
+       removed, are rehashed from the highest filled row down.
+    """
+    multiplier = 0x9E3779B97F4A7C15
+    # masks wider than 64 bits are folded modulo this prime
+    prime = 0xFFFFFFFFFFFFFFC5
+    mask = (1 << 64) - 1
+    # row keys of every number of rows, drawn from a fixed seed
+    tables = dict()
+
+    @staticmethod
+    def keys(rows):
+        """Returns the row keys of boards of a number of rows"""
+        keys = Zobrist.tables.get(rows)
+        if keys == None:
+            draw = random.Random(rows).getrandbits
+            keys = Zobrist.tables[rows] = [draw(64) for i in xrange(rows)]
+        return keys
+
+    @staticmethod
+    def rowHash(keys, row, mask):
+        """Returns the part of a row with a bitmask in a board hash"""
+        if mask == 0: return 0
+        h = ((mask % Zobrist.prime) ^ keys[row]) * Zobrist.multiplier & \
+                Zobrist.mask
+        return h ^ h >> 29
+
+    @staticmethod
+    def rangeHash(keys, bitboard, start, stop):
+        """Returns the xor of the parts of rows start to stop in a board
+           hash, the same as rowHash for each but in one call"""
+        multiplier, prime, mask, h = \
+                Zobrist.multiplier, Zobrist.prime, Zobrist.mask, 0
+        for i in xrange(start, stop):
+            row = bitboard[i]
+            if row:
+                row = ((row % prime) ^ keys[i]) * multiplier & mask
+                h ^= row ^ row >> 29
+        return h
+
+    @staticmethod
+    def boardHash(bitboard):
+        """Returns the hash of a board given as row bitmasks"""
+        return Zobrist.rangeHash(Zobrist.keys(len(bitboard)), bitboard, 0, \
+                len(bitboard))
+
+class GameState(object):
+    """Owns the board, the falling and next pieces, the score and the level.
+       All moves are applied here; views only read from it.
+       Cells hold indexes into the palette shared by all pieces and game
+       states; views turn them into colors when they draw.
+    """
+    __slots__ = ("rules", "rows", "cols", "seed", "generator", \
+            "piecesDrawn", "bitboard", "fullMask", "columnTops", \
+            "emptyRow", "cellColors", "ownedRows", "zobristKeys", \
+            "hashedBoard", "fallingPiece", "nextPiece", "score", "isOver", \
+            "history")
+    emptyColor = "blue"
+
+    def __init__(self, rules = Rules, seed = None, generator = None):
+        self.rules = rules
+        self.rows, self.cols = rules.rows, rules.cols
+        # the pieces are drawn from a seeded generator so games can be
+        # replayed; piecesDrawn is the position in its sequence
+        self.seed = seed if seed != None else random.getrandbits(32)
+        self.generator = generator if generator != None else \
+                PieceGenerator(Piece.knownNames(), self.seed, \
+                rules.pieceStrategy, rules.pieceWeights)
+        self.piecesDrawn = 0
+        # one bitmask per row, bit j set when column j is filled
+        self.bitboard = [0] * self.rows
+        self.fullMask = (1 << self.cols) - 1
+        # the height surface: the top filled row of every column, rows
+        # when it is empty, kept up to date as pieces lock and rows clear
+        self.columnTops = [self.rows] * self.cols
+        # Zobrist hash of the bitboard, kept up to date as pieces lock
+        # once it has been read; None until then, and once rows were
+        # removed until it is read again
+        self.zobristKeys = Zobrist.keys(self.rows)
+        self.hashedBoard = None
+        # palette indexes of the cell colors, one byte each, only used
+        # for rendering. Rows are copied on write: empty rows share
+        # emptyRow, and snapshots share the rows of the state, until a
+        # cell is set. Bit i of ownedRows is set once row i is the
+        # state's own, so mostly empty boards stay small however big
+        # they are and snapshots do not copy cells
+        self.emptyRow = bytearray(self.cols)
+        self.cellColors = [self.emptyRow] * self.rows
+        self.ownedRows = 0
+        self.fallingPiece, self.nextPiece = None, None
+        self.score = 0
+        self.isOver = False
+        # told about every lock and row removal when set, see History
+        self.history = None
+
+    @property
+    def level(self):
+        """Returns the user's current level"""
+        return GameState.levelOf(self.score)
+
+    @staticmethod
+    def levelOf(score):
+        """Returns the level reached with a score"""
+        return 0 if score // 5 == 0 else int(math.log(score / 5., 2))
+
+    @staticmethod
+    def clearScore(rules, fullRowCount, level):
+        """Returns the score earned by removing fullRowCount rows at once"""
+        if fullRowCount == 0: return 0
+        sm = rules.scoringMechanism
+        if sm == "Base-4 exponential": s = 4 ** (fullRowCount - 1)
+        elif sm == "Quadratic": s = fullRowCount ** 2
+        if rules.scoringLevelDependence == 1: s *= (level + 1)
+        return s
+
+    @property
+    def gravityDelay(self):
+        """Returns the number of milliseconds between two gravity steps"""
+        rows = min(self.rows, self.rules.maxGravityRows)
+        delay = int(7500. / rows - self.level * 50)
+        if delay < 750. / rows: delay = int(750. / rows)
+        return delay
+
+    @property
+    def palette(self):
+        """Returns the colors the cells index, shared by all game states"""
+        return Piece.palette
+
+    @property
+    def colorContent(self):
+        """Returns the color of every cell on the board"""
+        palette = Piece.palette
+        return [[palette[index] for index in row] for row in self.cellColors]
+
+    def colorIndex(self, color):
+        """Returns the palette index of a color, adding it if needed"""
+        return Piece.colorIndex(color)
+
+    def colorRow(self, row):
+        """Returns the cell colors of a row to write to, copying the row
+           first if the state does not own it"""
+        if not self.ownedRows >> row & 1:
+            self.cellColors[row] = bytearray(self.cellColors[row])
+            self.ownedRows |= 1 << row
+        return self.cellColors[row]
+
+    def setCell(self, row, col, color):
+        """Fills a cell with a color, or empties it with emptyColor"""
+        oldMask = self.bitboard[row]
+        if color == self.emptyColor:
+            self.bitboard[row] &= ~(1 << col)
+            if self.columnTops[col] == row:
+                self.columnTops[col] = self.columnTop(col, row)
+        else:
+            self.bitboard[row] |= 1 << col
+            if row < self.columnTops[col]: self.columnTops[col] = row
+        if self.hashedBoard != None:
+            self.hashedBoard ^= \
+                    Zobrist.rowHash(self.zobristKeys, row, oldMask) ^ \
+                    Zobrist.rowHash(self.zobristKeys, row, self.bitboard[row])
+        self.colorRow(row)[col] = self.colorIndex(color)
+
+    def columnTop(self, col, start = 0):
+        """Returns the top filled row of a column from start down"""
+        bitboard, bit = self.bitboard, 1 << col
+        for i in xrange(start, self.rows):
+            if bitboard[i] & bit: return i
+        return self.rows
+
+    def updateColumnTops(self):
+        """Recomputes the height surface after the bitboard was replaced"""
+        self.columnTops = [self.columnTop(j) for j in xrange(self.cols)]
+
+    @property
+    def boardHash(self):
+        """Returns the Zobrist hash of the bitboard. It is only computed
+           here, and rows moved by the removal of full rows are only
+           rehashed here, so games that never read it do not pay for it.
+        """
+        if self.hashedBoard == None:
+            self.hashedBoard = Zobrist.rangeHash(self.zobristKeys, \
+                    self.bitboard, min(self.columnTops), self.rows)
+        return self.hashedBoard
+
+    def updateBoardHash(self):
+        """Drops the board hash after the bitboard was replaced"""
+        self.hashedBoard = None
+
+    @property
+    def fallingPieceCells(self):
+        """Returns the indexes of cells occupied by the falling piece"""
+        if self.fallingPiece == None: return []
+        row, col = self.fallingPiece.position
+        return [(row + i, col + j) for i, j in self.fallingPiece.rotation.cells]
+
+    @property
+    def isLegal(self):
+        """Returns whether the falling piece does not overlap
+           with pieces already put on the board"""
+        if self.fallingPiece == None: return True
+        rotation = self.fallingPiece.rotation
+        row, col = self.fallingPiece.position
+        if row + rotation.height > self.rows or col + rotation.left < 0 or \
+           col + rotation.right >= self.cols:
+            return False
+        bitboard, masks = self.bitboard, rotation.masks
+        if col >= 0:
+            for i in xrange(rotation.height):
+                if bitboard[row + i] & (masks[i] << col): return False
+        else:
+            for i in xrange(rotation.height):
+                if bitboard[row + i] & (masks[i] >> -col): return False
+        return True
+
+    def randomPiece(self):
+        """Returns the next piece of the generator's sequence"""
+        name = self.generator.nameAt(self.piecesDrawn)
+        self.piecesDrawn += 1
+        return Piece(name, self.cols)
+
+    def rewindRandom(self, piecesDrawn):
+        """Puts the piece generator back to where it was after
+           piecesDrawn pieces had been drawn"""
+        self.piecesDrawn = piecesDrawn
+
+    def start(self):
+        """Starts the game by creating the next piece"""
+        self.nextPiece = self.randomPiece()
+
+    def newFallingPiece(self):
+        """Creates a new falling piece.
+           Ends game if it cannot be legally created.
+        """
+        if self.isOver: return
+        self.fallingPiece = self.nextPiece
+        self.nextPiece = self.randomPiece()
+        if not self.isLegal:
+            self.isOver = True
+
+    def moveFallingPiece(self, drow, dcol):
+        """Move the falling piece down. Creates a new falling piece if
+           the current one can't move or does not exist.
+        """
+        if self.isOver: return
+        fallingPiece = self.fallingPiece
+        if fallingPiece == None:
+            self.newFallingPiece()
+            return
+        fallingPiece.position[0] += drow
+        fallingPiece.position[1] += dcol
+        if not self.isLegal:
+            fallingPiece.position[0] -= drow
+            fallingPiece.position[1] -= dcol
+            if drow == 1:
+                self.putPieceOnBoard()
+                self.removeFullRows()
+                self.newFallingPiece()
+                return False
+        else: return True
+
+    @property
+    def dropDistance(self):
+        """Returns how many rows the falling piece can still fall.
+           Over the height surface this is read from the column tops
+           under its bottom profile; under an overhang the rows below
+           it are checked one by one.
+        """
+        piece = self.fallingPiece
+        if piece == None: return 0
+        rotation = piece.rotation
+        row, col = piece.position
+        tops, distance = self.columnTops, self.rows
+        for j, bottom in enumerate(rotation.bottoms):
+            if bottom < 0: continue
+            gap = tops[col + j] - row - bottom - 1
+            if gap < 0: return self.scanDropDistance()
+            if gap < distance: distance = gap
+        return distance
+
+    def scanDropDistance(self):
+        """Returns the drop distance found by moving the piece down"""
+        position, distance = self.fallingPiece.position, 0
+        while True:
+            position[0] += 1
+            if not self.isLegal: break
+            distance += 1
+        position[0] -= distance + 1
+        return distance
+
+    def hardDrop(self):
+        """Moves the falling piece down as far as possible, at once"""
+        if self.fallingPiece != None and not self.isOver:
+            self.fallingPiece.position[0] += self.dropDistance
+        self.moveFallingPiece(1, 0)
+
+    def rotateFallingPiece(self, direction = None):
+        """Rotates the falling piece about its upperleft corner
+           by changing the orientation variable of the piece object
+        """
+        if self.isOver or self.fallingPiece == None: return
+        if direction == None: direction = self.rules.rotationDirection
+        initialOrientation = self.fallingPiece.orientation
+        self.fallingPiece.orientation = (initialOrientation + direction) % 4
+        if not self.isLegal:
+            self.fallingPiece.orientation = initialOrientation
+
+    def applyMove(self, move):
+        """Applies a move given as the key symbol that plays it"""
+        if move == "Left": self.moveFallingPiece(0, -1)
+        elif move == "Right": self.moveFallingPiece(0, 1)
+        elif move == "Down": self.moveFallingPiece(1, 0)
+        elif move == "Up": self.rotateFallingPiece()
+        elif move == "Return": self.hardDrop()
+
+    def snapshot(self):
+        """Returns a Snapshot of the game, to restore it later.
+           It takes O(rows): the rows of cell colors are shared, not
+           copied, until the state writes to them.
+        """
+        falling, nextPiece = self.fallingPiece, self.nextPiece
+        self.ownedRows = 0
+        return Snapshot(self.piecesDrawn, self.score, self.isOver, \
+                None if falling == None else falling.name, \
+                0 if falling == None else falling.orientation, \
+                0 if falling == None else falling.position[0], \
+                0 if falling == None else falling.position[1], \
+                None if nextPiece == None else nextPiece.name, \
+                tuple(self.bitboard), tuple(self.columnTops), \
+                tuple(self.cellColors), self.hashedBoard)
+
+    def restore(self, snapshot):
+        """Puts the game back to a Snapshot taken from this state, or
+           from one with the same rules and piece generator, in O(rows)
+        """
+        self.piecesDrawn, self.score, self.isOver = snapshot.piecesDrawn, \
+                snapshot.score, snapshot.isOver
+        self.fallingPiece = None
+        if snapshot.falling != None:
+            self.fallingPiece = Piece(snapshot.falling, self.cols)
+            self.fallingPiece.orientation = snapshot.orientation
+            self.fallingPiece.position = [snapshot.row, snapshot.col]
+        self.nextPiece = None if snapshot.nextPiece == None else \
+                Piece(snapshot.nextPiece, self.cols)
+        self.bitboard = list(snapshot.bitboard)
+        self.columnTops = list(snapshot.columnTops)
+        self.cellColors = list(snapshot.cellColors)
+        self.ownedRows = 0
+        self.hashedBoard = snapshot.hashedBoard
+
+    def putPieceOnBoard(self):
+        """Put the falling piece on the board as it can't move down"""
+        if self.history != None: self.history.pieceLocked()
+        colorIndex = Piece.colorIndex(self.fallingPiece.color)
+        bitboard, columnTops = self.bitboard, self.columnTops
+        top = self.fallingPiece.position[0]
+        bottom = top + self.fallingPiece.rotation.height
+        if self.hashedBoard != None:
+            h = Zobrist.rangeHash(self.zobristKeys, bitboard, top, bottom)
+        for cell in self.fallingPieceCells:
+            bitboard[cell[0]] |= 1 << cell[1]
+            self.colorRow(cell[0])[cell[1]] = colorIndex
+            if cell[0] < columnTops[cell[1]]: columnTops[cell[1]] = cell[0]
+        if self.hashedBoard != None:
+            self.hashedBoard ^= h ^ \
+                    Zobrist.rangeHash(self.zobristKeys, bitboard, top, bottom)
+
+    def removeFullRows(self):
+        """Removes full rows and updates score and level.
+           Only the rows the falling piece was locked into are checked,
+           and all of them are removed in one pass.
+           Returns the number of rows removed.
+        """
+        bitboard, cellColors, fullMask = \
+                self.bitboard, self.cellColors, self.fullMask
+        if self.fallingPiece == None:
+            top, bottom = 0, self.rows
+        else:
+            top = self.fallingPiece.position[0]
+            bottom = top + self.fallingPiece.rotation.height
+        keptRows = [i for i in xrange(top, bottom) if bitboard[i] != fullMask]
+        fullRowCount = bottom - top - len(keptRows)
+        if fullRowCount != 0:
+            if self.history != None:
+                self.history.rowsRemoved([(i, cellColors[i]) \
+                        for i in xrange(top, bottom) \
+                        if bitboard[i] == fullMask])
+            # rows keep their objects and only move down, nothing is copied
+            bitboard[:bottom] = [0] * fullRowCount + bitboard[:top] + \
+                    [bitboard[i] for i in keptRows]
+            cellColors[:bottom] = [self.emptyRow] * fullRowCount + \
+                    cellColors[:top] + [cellColors[i] for i in keptRows]
+            # the rows moved are rehashed when the hash is next read
+            self.hashedBoard = None
+            # rows moved may be shared, they are copied on their next write
+            self.ownedRows &= ~((1 << bottom) - 1)
+            # every column is filled in the cleared rows, so its top was
+            # at or above them: above, it falls by fullRowCount; else the
+            # rows above it were empty and its next filled row is the top
+            columnTops = self.columnTops
+            for j in xrange(self.cols):
+                if columnTops[j] < top: columnTops[j] += fullRowCount
+                else:
+                    columnTops[j] = self.columnTop(j, \
+                            columnTops[j] + fullRowCount)
+            self.score += GameState.clearScore(self.rules, fullRowCount, \
+                    self.level)
+        self.fallingPiece = None
+        return fullRowCount
+
+# One precomputed orientation of a piece: the shape as nested tuples,
+# the offsets of its cells, its row bitmasks (bit j being column j),
+# the leftmost and rightmost columns it occupies, its bounding box and
+# its bottom profile, the lowest row it occupies in every column
+Rotation = collections.namedtuple("Rotation", ["shape", "cells", \
+        "masks", "left", "right", "height", "width", "bottoms"])
+
+# The whole of a game at one moment, as taken by GameState.snapshot:
+# the position in the piece sequence, the score, whether the game is
+# over, the name, orientation, row and column of the falling piece, the
+# name of the next piece, and the bitboard, column tops and cell colors
+# as tuples, and the board hash if known. The rows of cell colors are
+# shared and never written to
+Snapshot = collections.namedtuple("Snapshot", ["piecesDrawn", "score", \
+        "isOver", "falling", "orientation", "row", "col", "nextPiece", \
+        "bitboard", "columnTops", "cellColors", "hashedBoard"])
+
+class LazyDict(dict):
+    """A dict whose values can be given as loaders, functions without
+       arguments that are called the first time their key is looked up.
+       Keys that only have a loader are not in the dict yet.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.loaders = dict()
+
+    def __missing__(self, key):
+        value = self.loaders.pop(key)()
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self.loaders.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def setLoader(self, key, loader):
+        """Makes loader compute the value of key when it is looked up"""
+        dict.pop(self, key, None)
+        self.loaders[key] = loader
+
+    def discard(self, key):
+        """Removes a key and its loader, if any"""
+        dict.pop(self, key, None)
+        self.loaders.pop(key, None)
+
+class Piece(object):
+    """Class that stores properties of piece instants and
+       manages the piece database"""
+    __slots__ = ("name", "orientation", "position")
+    knownShapes = dict()
+    knownColors = dict()
+    # rotations can be loaded lazily from a piece library
+    knownRotations = LazyDict()
+    # canonical hash of every piece, and the pieces of every hash, to
+    # find the pieces of a shape in constant time
+    knownHashes = dict()
+    shapeIndex = dict()
+    knownShortcuts = dict()
+    # every color used by a piece or a cell, in a table shared by all
+    # pieces and game states, so cells only hold a one byte index.
+    # Index 0 is the color of empty cells; colors are never removed and
+    # there can be no more than a byte can count
+    palette = [GameState.emptyColor]
+    paletteIndexes = {GameState.emptyColor: 0}
+    maxPaletteSize = 255
+    standardPieces = \
+        ["iPiece", "jPiece", "lPiece", "oPiece", "sPiece", "tPiece", "zPiece"]
+
+    def __str__(self):
+        return """Piece name: {0};
+Piece color: {1};
+Piece position: {2};
+Piece shape: {3}.""".format(self.name, self.color, self.position, self.shape)
+
+    def __init__(self, name, boardCols):
+        self.name = name
+        self.orientation = 0
+
+        self.position = [0, boardCols // 2 - \
+                Piece.knownRotations[name][0].width // 2]
+
+    @staticmethod
+    def learnPiece(name, shape, color):
+        """Add a piece to the piece database
+           and precomputes its 4 orientations.
+           Raises ValueError, learning nothing, when the palette is full.
+        """
+        Piece.colorIndex(color)
+        Piece.knownShapes[name] = shape
+        Piece.knownColors[name] = color
+        rotations = Piece.makeRotations(shape)
+        Piece.knownRotations[name] = rotations
+        Piece.indexPiece(name, Piece.canonicalHash(rotations))
+
+    @staticmethod
+    def forgetPiece(name):
+        """Removes a piece from the piece database"""
+        Piece.knownShapes.pop(name)
+        Piece.knownColors.pop(name)
+        Piece.knownRotations.discard(name)
+        Piece.unindexPiece(name)
+
+    @staticmethod
+    def knownNames():
+        """Returns the names of the known pieces in a fixed order, the
+           standard pieces first then the others sorted, so the pieces
+           of a seed are the same whatever order they were learnt in"""
+        return [name for name in Piece.standardPieces \
+                if name in Piece.knownShapes] + sorted(name for name in \
+                Piece.knownShapes if name not in Piece.standardPieces)
+
+    @staticmethod
+    def colorIndex(color):
+        """Returns the palette index of a color, adding it if needed"""
+        index = Piece.paletteIndexes.get(color)
+        if index == None:
+            index = len(Piece.palette)
+            if index == Piece.maxPaletteSize:
+                raise ValueError("more than {0} colors" \
+                        .format(Piece.maxPaletteSize))
+            Piece.palette.append(color)
+            Piece.paletteIndexes[color] = index
+        return index
+
+    @staticmethod
+    def indexPiece(name, canonicalHash):
+        """Records the canonical hash of a known piece"""
+        Piece.unindexPiece(name)
+        Piece.knownHashes[name] = canonicalHash
+        Piece.shapeIndex.setdefault(canonicalHash, []).append(name)
+
+    @staticmethod
+    def unindexPiece(name):
+        """Forgets the canonical hash of a piece, if it has one"""
+        canonicalHash = Piece.knownHashes.pop(name, None)
+        if canonicalHash == None: return
+        names = Piece.shapeIndex[canonicalHash]
+        names.remove(name)
+        if not names: del Piece.shapeIndex[canonicalHash]
+
+    @staticmethod
+    def findShape(shape, reflections = False):
+        """Returns the name of a known piece that is the shape turned,
+           or also mirrored when reflections, or None if there is none.
+           Looks the shape up in the index instead of comparing it with
+           every known piece.
+        """
+        candidates = [shape, Piece.getMirrorImage(shape)] if reflections \
+                else [shape]
+        for candidate in candidates:
+            rotations = Piece.makeRotations(candidate)
+            form = Piece.canonicalForm(rotations)
+            for name in Piece.shapeIndex.get(\
+                    Piece.canonicalHash(rotations), ()):
+                # different forms only share a hash by accident
+                if Piece.canonicalForm(Piece.knownRotations[name]) == form:
+                    return name
+        return None
+
+    @staticmethod
+    def isConnected(shape):
+        """Returns whether the cells of a shape are all joined by their
+           sides, with a flood fill from one of them"""
+        cells = set((i, j) for i in xrange(len(shape)) \
+                for j in xrange(len(shape[i])) if shape[i][j])
+        if not cells: return False
+        stack = [next(iter(cells))]
+        cells.discard(stack[0])
+        while stack:
+            i, j = stack.pop()
+            for neighbor in ((i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1)):
+                if neighbor in cells:
+                    cells.discard(neighbor)
+                    stack.append(neighbor)
+        return not cells
+
+    @staticmethod
+    def trimShape(shape):
+        """Returns the shape cut down to the bounding box of its cells,
+           or an empty list if it has none"""
+        rows = [i for i in xrange(len(shape)) if any(shape[i])]
+        cols = [j for j in xrange(len(shape[0]) if shape else 0) \
+                if any(row[j] for row in shape)]
+        if not rows: return []
+        return [list(shape[i][cols[0]:cols[-1] + 1]) \
+                for i in xrange(rows[0], rows[-1] + 1)]
+
+    @staticmethod
+    def canonicalForm(rotations):
+        """Returns the (height, width, masks) of the smallest of the
+           rotations, the same for a shape and any rotation of it"""
+        return min((r.height, r.width, r.masks) for r in rotations)
+
+    @staticmethod
+    def canonicalHash(rotations):
+        """Returns a 64-bit hash of the canonical form of the rotations,
+           stable across runs and Python versions"""
+        height, width, masks = Piece.canonicalForm(rotations)
+        rowBytes = (width + 7) // 8
+        data = bytearray([height, width])
+        for mask in masks:
+            data += bytearray((mask >> 8 * k) & 0xFF \
+                    for k in xrange(rowBytes))
+        return int(hashlib.sha1(bytes(data)).hexdigest()[:16], 16)
+
+    @staticmethod
+    def makeRotations(shape):
+        """Returns the precomputed Rotations of the 4 orientations"""
+        return (Piece.makeRotation(shape), \
+                Piece.makeRotation(Piece.getShapeCase1(shape)), \
+                Piece.makeRotation(Piece.getShapeCase2(shape)), \
+                Piece.makeRotation(Piece.getShapeCase3(shape)))
+
+    @staticmethod
+    def makeRotation(shape):
+        """Returns the precomputed Rotation of a shape"""
+        shape = tuple(tuple(bool(cell) for cell in row) for row in shape)
+        cells = tuple((i, j) for i in xrange(len(shape)) \
+                for j in xrange(len(shape[0])) if shape[i][j])
+        masks = tuple(sum(1 << j for j in xrange(len(row)) if row[j]) \
+                for row in shape)
+        span = 0
+        for mask in masks: span |= mask
+        return Rotation(shape, cells, masks, (span & -span).bit_length() - 1, \
+                span.bit_length() - 1, len(shape), len(shape[0]), \
+                Piece.bottomsOf(cells, len(shape[0])))
+
+    @staticmethod
+    def bottomsOf(cells, width):
+        """Returns the lowest row of cells in every column, -1 if none"""
+        bottoms = [-1] * width
+        for i, j in cells:
+            if i > bottoms[j]: bottoms[j] = i
+        return tuple(bottoms)
+
+    @staticmethod
+    def learnStandardPieces():
+        """Save the 7 standard pieces"""
+        Piece.learnPiece("iPiece", \
+                [[True, True, True, True]], "red")
+        Piece.learnPiece("jPiece", \
+                [[True, False, False], [True, True, True]], "yellow")
+        Piece.learnPiece("lPiece", \
+                [[False, False, True], [True, True, True]], "magenta")
+        Piece.learnPiece("oPiece", \
+                [[True, True], [True, True]], "pink")
+        Piece.learnPiece("sPiece", \
+                [[False, True, True], [True, True, False]], "cyan")
+        Piece.learnPiece("tPiece", \
+                [[False, True, False], [True, True, True]], "green")
+        Piece.learnPiece("zPiece", \
+                [[True, True, False], [False, True, True]], "orange")
+
+    @property
+    def color(self):
+        """Returns the piece color"""
+        return Piece.knownColors[self.name]
+
+    @property
+    def rotation(self):
+        """Returns the precomputed Rotation of the piece
+           given the piece's orientation
+        """
+        return Piece.knownRotations[self.name][self.orientation]
+
+    @property
+    def shape(self):
+        """Returns the piece shape under global coordinate
+           given the piece's orientation
+        """
+        return Piece.knownRotations[self.name][self.orientation].shape
+
+    @staticmethod
+    def getShapeCase1(shape):
+        """Returns the shape under global coordinate when the piece
+           is 90 degrees clockwise from the initial state
+        """
+        result = []
+        for j in xrange(len(shape[0])):
+            subResult = []
+            for i in xrange(len(shape) - 1, -1, -1):
+                subResult.append(shape[i][j])
+            result.append(subResult)
+        return result
+
+    @staticmethod
+    def getShapeCase2(shape):
+        """Returns the shape under global coordinate when the piece
+           is 180 degrees clockwise from the initial state
+        """
+        result = []
+        for i in xrange(len(shape) - 1, -1, -1):
+            subResult = []
+            for j in xrange(len(shape[0]) - 1, -1, -1):
+                subResult.append(shape[i][j])
+            result.append(subResult)
+        return result
+
+    @staticmethod
+    def getShapeCase3(shape):
+        """Returns the shape under global coordinate when the piece
+           is 90 degrees counterclockwise from the initial state
+        """
+        result = []
+        for j in xrange(len(shape[0]) - 1, -1, -1):
+            subResult = []
+            for i in xrange(len(shape)):
+                subResult.append(shape[i][j])
+            result.append(subResult)
+        return result
+
+    @staticmethod
+    def getMirrorImage(shape):
+        """Returns the shape flipped left to right"""
+        return [list(reversed(row)) for row in shape]
@@ -0,0 +1,178 @@
+"""Undo and redo of the pieces locked in a game.
+
+The history keeps a delta per piece locked rather than whole boards:
+where the piece locked, the rows it removed with their colors, and the
+score and position in the piece sequence before it. Undoing puts the
+removed rows back and lifts the piece off the board, redoing locks it
+again. Only the last depth locks are kept, so memory stays flat however
+long the game, and a snapshot of the game is kept every snapshotInterval
+locks so that jumping far back or forth replays few deltas.
+"""
+import collections
+from tetris_engine import Piece
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class Lock(object):
+    """The delta of a piece locked on the board"""
+    __slots__ = ("name", "orientation", "row", "col", "score", \
+            "piecesDrawn", "removedRows", "snapshot")
+
+    def __init__(self, piece, score, piecesDrawn, snapshot = None):
+        self.name, self.orientation = piece.name, piece.orientation
+        self.row, self.col = piece.position
+        self.score, self.piecesDrawn = score, piecesDrawn
+        # (row, cell colors) of the rows removed, top to bottom
+        self.removedRows = ()
+        # the game before the lock, kept every snapshotInterval locks
+        self.snapshot = snapshot
+
+class History(object):
+    """Records the locks of a game state to step back and forth through
+       them. The position is the number of locks played, from the oldest
+       one kept; undoing and redoing move it one piece at a time, and
+       leave the falling piece where it appeared. Playing on after an
+       undo drops the locks that could have been redone.
+    """
+    def __init__(self, state, depth = 1000, snapshotInterval = 50):
+        if depth < 1: raise ValueError("the history must keep a lock")
+        self.state = state
+        self.depth, self.snapshotInterval = depth, max(1, snapshotInterval)
+        self.locks = collections.deque(maxlen = depth)
+        self.position = 0
+        # locks recorded in all, to place snapshots when old locks go
+        self.lockCount = 0
+        self.pending = None
+        state.history = self
+
+    @property
+    def canUndo(self):
+        return self.position > 0
+
+    @property
+    def canRedo(self):
+        return self.position < len(self.locks)
+
+    def clear(self):
+        """Forgets every lock, when the game was changed another way"""
+        self.locks.clear()
+        self.position, self.pending = 0, None
+
+    def detach(self):
+        """Stops recording the game state"""
+        if self.state.history is self: self.state.history = None
+
+    def pieceLocked(self):
+        """Called by the game state before it locks the falling piece"""
+        state = self.state
+        while len(self.locks) > self.position:
+            self.locks.pop()
+        snapshot = state.snapshot() \
+                if self.lockCount % self.snapshotInterval == 0 else None
+        self.pending = Lock(state.fallingPiece, state.score, \
+                state.piecesDrawn, snapshot)
+        if len(self.locks) == self.depth: self.position -= 1
+        self.locks.append(self.pending)
+        self.position += 1
+        self.lockCount += 1
+
+    def rowsRemoved(self, rows):
+        """Called by the game state before it removes full rows, given
+           as (row, cell colors), after the piece that filled them locked.
+           The colors are kept as they are: the state drops the rows.
+        """
+        if self.pending != None and self.state.fallingPiece != None:
+            self.pending.removedRows = tuple(rows)
+        self.pending = None
+
+    def undo(self, count = 1):
+        """Steps back count locks. Returns how many it stepped back."""
+        target = max(0, self.position - count)
+        moved = self.position - target
+        self.seek(target)
+        return moved
+
+    def redo(self, count = 1):
+        """Steps forth count locks. Returns how many it stepped forth."""
+        target = min(len(self.locks), self.position + count)
+        moved = target - self.position
+        self.seek(target)
+        return moved
+
+    def seek(self, position):
+        """Puts the game where it was after position locks, from the
+           current position or the snapshot closest to it"""
+        if not 0 <= position <= len(self.locks):
+            raise IndexError("no lock {0} in the history".format(position))
+        snapshotPosition = self.closestSnapshot(position)
+        if snapshotPosition != None and abs(position - snapshotPosition) < \
+                abs(position - self.position):
+            self.restoreSnapshot(snapshotPosition)
+        while self.position > position:
+            self.stepBack()
+        while self.position < position:
+            self.stepForth()
+
+    def closestSnapshot(self, position):
+        """Returns the position of the snapshot closest to a position,
+           or None if there is none within snapshotInterval of it"""
+        locks, interval = self.locks, self.snapshotInterval
+        for distance in xrange(interval + 1):
+            for p in (position - distance, position + distance):
+                if 0 <= p < len(locks) and locks[p].snapshot != None:
+                    return p
+        return None
+
+    def restoreSnapshot(self, position):
+        lock = self.locks[position]
+        self.state.restore(lock.snapshot)
+        self.state.fallingPiece = Piece(lock.name, self.state.cols)
+        self.position = position
+
+    def stepBack(self):
+        """Undoes the last lock played"""
+        self.position -= 1
+        lock, state = self.locks[self.position], self.state
+        bitboard, cellColors = state.bitboard, state.cellColors
+        rotation = Piece.knownRotations[lock.name][lock.orientation]
+        bottom = lock.row + rotation.height
+        # the rows removed come back and the empty rows added go
+        count = len(lock.removedRows)
+        if count != 0:
+            del bitboard[:count]
+            del cellColors[:count]
+            for row, colors in lock.removedRows:
+                bitboard.insert(row, state.fullMask)
+                cellColors.insert(row, colors)
+        # rows moved may be shared, they are copied on their next write
+        state.ownedRows &= ~((1 << bottom) - 1)
+        for i, j in rotation.cells:
+            row, col = lock.row + i, lock.col + j
+            bitboard[row] &= ~(1 << col)
+            state.colorRow(row)[col] = 0
+        state.updateColumnTops()
+        state.updateBoardHash()
+        state.score, state.piecesDrawn = lock.score, lock.piecesDrawn
+        state.isOver = False
+        state.fallingPiece = Piece(lock.name, state.cols)
+        state.nextPiece = Piece(state.generator.nameAt(lock.piecesDrawn - 1), \
+                state.cols)
+        self.pending = None
+
+    def stepForth(self):
+        """Plays the next lock undone again"""
+        lock, state = self.locks[self.position], self.state
+        state.fallingPiece = Piece(lock.name, state.cols)
+        state.fallingPiece.orientation = lock.orientation
+        state.fallingPiece.position = [lock.row, lock.col]
+        state.history = None
+        try:
+            state.putPieceOnBoard()
+            state.removeFullRows()
+            state.newFallingPiece()
+        finally:
+            state.history = self
+        self.position += 1
@@ -0,0 +1,84 @@
+"""Keyboard state with delayed auto-shift and auto-repeat.
+
+Key repeat from the operating system is ignored: a held key is pressed
+once, then repeats after delay milliseconds and every rate milliseconds
+after that, as in most Tetris games. Moves queue up until poll takes
+them, so a frame plays every move that came in since the last one.
+"""
+import timeit
+
+class KeyRepeater(object):
+    """Turns key presses and releases into moves.
+       Only repeatKeys auto-repeat; of two opposite keys held at once,
+       the one pressed last repeats. A key repeats at most maxRepeats
+       times per poll, so a late poll does not replay a burst of moves.
+    """
+    opposites = {"Left": "Right", "Right": "Left"}
+
+    def __init__(self, delay = 170, rate = 50, \
+            repeatKeys = ("Left", "Right", "Down"), maxRepeats = 20, \
+            clock = timeit.default_timer):
+        if rate <= 0: raise ValueError("the repeat rate must be positive")
+        self.delay, self.rate = delay, rate
+        self.maxRepeats = maxRepeats
+        self.repeatKeys = repeatKeys
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """Forgets the keys held and the moves not polled yet"""
+        # key symbol -> time of its next repeat, None if it does not repeat
+        self.held = {}
+        self.pressOrder, self.presses = {}, 0
+        # keys released since the last poll; X11 follows every repeated
+        # release with a press, which cancels the release
+        self.releasing = set()
+        self.moves = []
+
+    def press(self, keysym):
+        """Registers a key press, playing its move on the first one"""
+        if keysym in self.releasing:
+            self.releasing.discard(keysym)
+            return
+        if keysym in self.held: return
+        self.moves.append(keysym)
+        self.presses += 1
+        self.pressOrder[keysym] = self.presses
+        self.held[keysym] = self.clock() + self.delay / 1000. \
+                if keysym in self.repeatKeys else None
+
+    def release(self, keysym):
+        """Registers a key release, effective at the next poll"""
+        if keysym in self.held: self.releasing.add(keysym)
+
+    def releaseAll(self):
+        """Releases every key, e.g. when the window loses the focus"""
+        self.releasing.update(self.held)
+
+    def isRepeating(self, keysym):
+        """Returns whether a held key is not overridden by its opposite"""
+        opposite = KeyRepeater.opposites.get(keysym)
+        return opposite not in self.held or \
+                self.pressOrder[opposite] < self.pressOrder[keysym]
+
+    def poll(self):
+        """Returns the moves played since the last poll, in order,
+           with the repeats of the held keys that came due"""
+        now = self.clock()
+        for keysym in self.releasing:
+            del self.held[keysym]
+        self.releasing.clear()
+        for keysym, due in self.held.items():
+            if due == None: continue
+            if not self.isRepeating(keysym):
+                # the auto-shift starts over once the opposite is released
+                self.held[keysym] = now + self.delay / 1000.
+                continue
+            repeats = 0
+            while due <= now and repeats < self.maxRepeats:
+                self.moves.append(keysym)
+                due += self.rate / 1000.
+                repeats += 1
+            self.held[keysym] = max(due, now)
+        moves, self.moves = self.moves, []
+        return moves
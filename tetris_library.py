@@ -0,0 +1,208 @@
+"""On-disk library of pieces with their precomputed metadata.
+
+A library file holds, for every piece, its name, color and shape, the
+canonical hash of the shape, the column offset it spawns at from the
+middle of the board and its 4 precomputed rotations: bounding boxes,
+occupied columns and row bitmasks. It is read in one go and nothing is
+recomputed; in large libraries the rotations are only decoded when a
+piece is first used. Saving writes a new file then moves it over the
+old one, so a crash never leaves a half-written library.
+"""
+import os
+import struct
+import tempfile
+from tetris_engine import Piece, Rotation
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class PieceLibrary(object):
+    """Saves the piece database to a file and loads it back"""
+    magic, version = b"TTPL", 1
+    # name, color, shape and rotations lengths then offset, canonical
+    # hash, spawn offset, shape height and width
+    recordLayout = ">HHHHIQbBB"
+    # libraries with more pieces than this load their rotations lazily
+    lazyThreshold = 64
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def packBits(rows, width):
+        """Packs row bitmasks, (width + 7) // 8 little-endian bytes each"""
+        rowBytes = (width + 7) // 8
+        data = bytearray()
+        for mask in rows:
+            data += bytearray((mask >> 8 * k) & 0xFF \
+                    for k in xrange(rowBytes))
+        return data
+
+    @staticmethod
+    def unpackBits(data, offset, height, width):
+        """Returns the row bitmasks packed by packBits at an offset"""
+        rowBytes = (width + 7) // 8
+        masks = []
+        for i in xrange(height):
+            start = offset + i * rowBytes
+            mask = 0
+            for k in xrange(rowBytes):
+                mask |= data[start + k] << 8 * k
+            masks.append(mask)
+        return masks
+
+    @staticmethod
+    def encodeRotations(rotations):
+        data = bytearray()
+        for r in rotations:
+            data += struct.pack(">BBBB", r.height, r.width, r.left, r.right)
+            data += PieceLibrary.packBits(r.masks, r.width)
+        return data
+
+    @staticmethod
+    def decodeRotations(data, offset):
+        """Rebuilds the 4 Rotations of a piece without recomputing them"""
+        rotations = []
+        for o in xrange(4):
+            height, width, left, right = data[offset:offset + 4]
+            masks = tuple(PieceLibrary.unpackBits(data, offset + 4, \
+                    height, width))
+            shape = tuple(tuple(bool(mask >> j & 1) for j in xrange(width)) \
+                    for mask in masks)
+            cells = tuple((i, j) for i in xrange(height) \
+                    for j in xrange(width) if masks[i] >> j & 1)
+            rotations.append(Rotation(shape, cells, masks, left, right, \
+                    height, width, Piece.bottomsOf(cells, width)))
+            offset += 4 + height * ((width + 7) // 8)
+        return tuple(rotations)
+
+    @staticmethod
+    def toBytes(names):
+        """Returns the library of the named known pieces"""
+        records, blobs, blobOffset = [], [], 0
+        for name in names:
+            shape, rotations = Piece.knownShapes[name], \
+                    Piece.knownRotations[name]
+            first = Piece.makeRotation(shape)
+            blob = PieceLibrary.encodeRotations(rotations)
+            encodedName = name.encode("utf-8")
+            encodedColor = Piece.knownColors[name].encode("utf-8")
+            shapeBits = PieceLibrary.packBits(first.masks, first.width)
+            records.append(bytearray(struct.pack(PieceLibrary.recordLayout, \
+                    len(encodedName), len(encodedColor), len(shapeBits), \
+                    len(blob), blobOffset, Piece.knownHashes[name], \
+                    -(rotations[0].width // 2), first.height, first.width)) \
+                    + encodedName + encodedColor + shapeBits)
+            blobs.append(blob)
+            blobOffset += len(blob)
+        data = bytearray(PieceLibrary.magic)
+        data += struct.pack(">BI", PieceLibrary.version, len(records))
+        for record in records:
+            data += record
+        for blob in blobs:
+            data += blob
+        return bytes(data)
+
+    @staticmethod
+    def learnBytes(data, lazy = None):
+        """Adds the pieces of a library to the piece database.
+           lazy defaults to whether there are more than lazyThreshold.
+           Returns the names of the pieces, in the library's order.
+        """
+        data = bytearray(data)
+        if data[:4] != PieceLibrary.magic:
+            raise ValueError("not a piece library")
+        if len(data) < 9:
+            raise ValueError("truncated piece library")
+        version, count = struct.unpack_from(">BI", bytes(data[:9]), 4)
+        if version != PieceLibrary.version:
+            raise ValueError("unsupported piece library version {0}" \
+                    .format(version))
+        if lazy == None: lazy = count > PieceLibrary.lazyThreshold
+        offset, size = 9, struct.calcsize(PieceLibrary.recordLayout)
+        pieces, blobsLength = [], 0
+        try:
+            for p in xrange(count):
+                nameLength, colorLength, shapeLength, blobLength, \
+                        blobOffset, canonicalHash, spawnOffset, height, \
+                        width = struct.unpack(PieceLibrary.recordLayout, \
+                        bytes(data[offset:offset + size]))
+                offset += size
+                name = bytes(data[offset:offset + nameLength]) \
+                        .decode("utf-8")
+                offset += nameLength
+                color = bytes(data[offset:offset + colorLength]) \
+                        .decode("utf-8")
+                offset += colorLength
+                masks = PieceLibrary.unpackBits(data, offset, height, width)
+                offset += shapeLength
+                shape = [[bool(mask >> j & 1) for j in xrange(width)] \
+                        for mask in masks]
+                pieces.append((name, color, shape, canonicalHash, blobOffset))
+                blobsLength += blobLength
+        except (struct.error, IndexError):
+            raise ValueError("truncated piece library")
+        # rotations may be decoded later, so check they are all there now
+        if offset + blobsLength != len(data):
+            raise ValueError("truncated piece library")
+        # a full palette raises ValueError before any piece is learnt
+        for name, color, shape, canonicalHash, blobOffset in pieces:
+            Piece.colorIndex(color)
+        for name, color, shape, canonicalHash, blobOffset in pieces:
+            Piece.knownShapes[name] = shape
+            Piece.knownColors[name] = color
+            Piece.indexPiece(name, canonicalHash)
+            if lazy:
+                Piece.knownRotations.setLoader(name, \
+                        PieceLibrary.rotationLoader(data, offset + blobOffset))
+            else:
+                Piece.knownRotations[name] = \
+                        PieceLibrary.decodeRotations(data, offset + blobOffset)
+        return [name for name, color, shape, h, o in pieces]
+
+    @staticmethod
+    def rotationLoader(data, offset):
+        return lambda: PieceLibrary.decodeRotations(data, offset)
+
+    def load(self, lazy = None):
+        """Adds the pieces of the library file to the piece database.
+           Returns their names, or None when there is no file yet.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except IOError:
+            if os.path.exists(self.path): raise
+            return None
+        return PieceLibrary.learnBytes(data, lazy)
+
+    def save(self, names = None):
+        """Writes the named known pieces, or all of them, to the file.
+           The file is replaced at once, never partly written.
+        """
+        if names == None: names = Piece.knownNames()
+        data = PieceLibrary.toBytes(names)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temporaryPath = tempfile.mkstemp(dir = directory, \
+                prefix = ".pieces")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp makes the file private, give it the usual mode
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporaryPath, 0o666 & ~umask)
+            if hasattr(os, "replace"):
+                os.replace(temporaryPath, self.path)
+            else:
+                # rename only replaces an existing file on POSIX
+                if os.name == "nt" and os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(temporaryPath, self.path)
+        except:
+            if os.path.exists(temporaryPath): os.remove(temporaryPath)
+            raise
@@ -0,0 +1,159 @@
+"""Enumeration of polyominoes, to play with pentominoes and beyond.
+
+    python tetris_polyomino.py 5 [--kind free] [--learn pieces.ttpl]
+
+Polyominoes of n cells are grown one cell at a time with Redelmeier's
+algorithm, which reaches every fixed polyomino exactly once without
+remembering the ones found so far. A polyomino is kept only if it is the
+canonical orientation among its rotations, and mirror images for free
+polyominoes, so shapes are streamed one by one, in constant memory
+beyond the current one.
+"""
+import argparse
+import sys
+from tetris_engine import Piece
+from tetris_library import PieceLibrary
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class Polyominoes(object):
+    """Enumerates the polyominoes of a size, as piece shapes.
+       kind is fixed (every orientation apart), oneSided (the same when
+       rotated, as Tetris pieces) or free (also the same when mirrored).
+    """
+    kinds = ("fixed", "oneSided", "free")
+    # colors given to learnt pieces in turn
+    colors = ("red", "yellow", "magenta", "pink", "cyan", "green", \
+            "orange", "purple", "brown", "white")
+
+    def __init__(self, size, kind = "free"):
+        if size < 1: raise ValueError("a polyomino has at least one cell")
+        if kind not in Polyominoes.kinds:
+            raise ValueError("unknown polyomino kind {0}".format(kind))
+        self.size, self.kind = size, kind
+
+    def fixedCells(self):
+        """Yields the cells of every fixed polyomino, as (row, col)
+           tuples. The first cell is the origin and no cell comes before
+           it in reading order, so each polyomino is grown only once.
+        """
+        size = self.size
+        cells = []
+        # cells that are in the polyomino or next to it, never to be
+        # added to the untried cells again further down
+        reached = set([(0, 0)])
+
+        def grow(untried):
+            while untried:
+                cell = untried.pop()
+                cells.append(cell)
+                if len(cells) == size:
+                    yield tuple(cells)
+                else:
+                    i, j = cell
+                    neighbors = [(i + di, j + dj) for di, dj in \
+                            ((1, 0), (0, 1), (0, -1), (-1, 0)) \
+                            if (i + di > 0 or i + di == 0 and j + dj >= 0) \
+                            and (i + di, j + dj) not in reached]
+                    reached.update(neighbors)
+                    for polyomino in grow(untried + neighbors):
+                        yield polyomino
+                    reached.difference_update(neighbors)
+                cells.pop()
+
+        return grow([(0, 0)])
+
+    @staticmethod
+    def normalize(cells):
+        """Returns (height, sorted cells) of cells moved to the corner"""
+        top = min(i for i, j in cells)
+        left = min(j for i, j in cells)
+        cells = sorted((i - top, j - left) for i, j in cells)
+        return (cells[-1][0] + 1, tuple(cells))
+
+    def orientations(self, cells):
+        """Returns the cells in every orientation of the kind"""
+        if self.kind == "fixed": return [cells]
+        result, turned = [], cells
+        for k in xrange(4):
+            result.append(turned)
+            turned = [(j, -i) for i, j in turned]
+        if self.kind == "free":
+            result += [[(i, -j) for i, j in rotated] for rotated in result]
+        return result
+
+    def canonicalCells(self, cells):
+        """Returns the cells if they are the canonical orientation of
+           their polyomino, the flattest one first, else None"""
+        own = Polyominoes.normalize(cells)
+        for turned in self.orientations(cells)[1:]:
+            if Polyominoes.normalize(turned) < own: return None
+        return own
+
+    @staticmethod
+    def toShape(height, cells):
+        width = max(j for i, j in cells) + 1
+        shape = [[False] * width for i in xrange(height)]
+        for i, j in cells:
+            shape[i][j] = True
+        return shape
+
+    def __iter__(self):
+        """Yields the shape of every polyomino of the kind"""
+        for cells in self.fixedCells():
+            canonical = self.canonicalCells(cells)
+            if canonical != None: yield Polyominoes.toShape(*canonical)
+
+    def learn(self, colors = None):
+        """Adds the polyominoes to the piece database, named like the
+           pieces of the piece editor and colored in turn from colors.
+           Shapes already known, as pieces of the same kind, are skipped.
+           Yields the names of the pieces added.
+        """
+        colors = colors or Polyominoes.colors
+        k = 0
+        for shape in self:
+            if self.kind != "fixed" and \
+                    Piece.findShape(shape, self.kind == "free") != None:
+                continue
+            name = str(shape)
+            if name in Piece.knownShapes: continue
+            Piece.learnPiece(name, shape, colors[k % len(colors)])
+            k += 1
+            yield name
+
+    @staticmethod
+    def shapeText(shape):
+        """Returns the shape drawn with # and ., one row per line"""
+        return "\n".join("".join("#" if cell else "." for cell in row) \
+                for row in shape)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = \
+            "Lists, or adds to a piece library, the polyominoes of a size.")
+    parser.add_argument("size", type = int)
+    parser.add_argument("--kind", choices = Polyominoes.kinds, \
+            default = "free")
+    parser.add_argument("--learn", metavar = "LIBRARY", \
+            help = "add the polyominoes to this piece library")
+    args = parser.parse_args(argv)
+    polyominoes = Polyominoes(args.size, args.kind)
+    count = 0
+    if args.learn:
+        library = PieceLibrary(args.learn)
+        if library.load() == None: Piece.learnStandardPieces()
+        for name in polyominoes.learn():
+            count += 1
+        library.save()
+    else:
+        for shape in polyominoes:
+            sys.stdout.write(Polyominoes.shapeText(shape) + "\n\n")
+            count += 1
+    sys.stderr.write("{0} polyominoes\n".format(count))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
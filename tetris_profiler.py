@@ -0,0 +1,147 @@
+"""Per-frame timings of the game loop.
+
+A FrameProfiler splits every frame into phases, keeps the timings of the
+last frames in rolling histograms and reports their percentiles. The
+game only creates one while its overlay is shown, so timing costs
+nothing otherwise.
+"""
+import json
+import math
+import timeit
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class FrameProfiler(object):
+    """Times the phases of every frame and keeps rolling histograms of
+       the last window frames.
+       Phases nest: the time spent in an inner phase is not counted in
+       the outer one. Besides the phases, every frame records busy, the
+       total of its phases, and interval, the time since the last frame.
+    """
+    phases = ("input", "simulation", "draw", "update")
+    measures = phases + ("busy", "interval")
+    # histogram buckets grow by 2 ** (1 / 8) from a microsecond on, so
+    # percentiles are within 9% and the last bucket starts at 16 seconds
+    bucketsPerOctave = 8
+    bucketCount = 8 * 24
+    minTime = 1e-6
+
+    def __init__(self, window = 600):
+        self.window = window
+        self.frames = 0
+        self.samples = dict((m, [0.] * window) \
+                for m in FrameProfiler.measures)
+        self.histograms = dict((m, [0] * FrameProfiler.bucketCount) \
+                for m in FrameProfiler.measures)
+        self.itemCounts = [0] * window
+        self.current = dict((phase, 0.) for phase in FrameProfiler.phases)
+        self.stack, self.mark = [], None
+        self.lastFrameEnd = None
+
+    @staticmethod
+    def bucketOf(seconds):
+        """Returns the histogram bucket of a duration"""
+        if seconds <= FrameProfiler.minTime: return 0
+        bucket = int(math.log(seconds / FrameProfiler.minTime, 2) * \
+                FrameProfiler.bucketsPerOctave) + 1
+        return min(bucket, FrameProfiler.bucketCount - 1)
+
+    @staticmethod
+    def bucketLimit(bucket):
+        """Returns the longest duration that falls in a bucket"""
+        return FrameProfiler.minTime * \
+                2 ** (float(bucket) / FrameProfiler.bucketsPerOctave)
+
+    def begin(self, phase):
+        """Starts timing a phase of the current frame"""
+        now = timeit.default_timer()
+        if self.stack: self.current[self.stack[-1]] += now - self.mark
+        self.stack.append(phase)
+        self.mark = now
+
+    def end(self):
+        """Stops timing the phase begun last"""
+        now = timeit.default_timer()
+        self.current[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def endFrame(self, itemCount = 0):
+        """Records the current frame, with the number of canvas items
+           drawn, and starts the next one"""
+        now = timeit.default_timer()
+        values = dict(self.current)
+        values["busy"] = sum(self.current.values())
+        values["interval"] = 0. if self.lastFrameEnd == None else \
+                now - self.lastFrameEnd
+        slot = self.frames % self.window
+        for measure in FrameProfiler.measures:
+            samples = self.samples[measure]
+            histogram = self.histograms[measure]
+            if self.frames >= self.window:
+                histogram[FrameProfiler.bucketOf(samples[slot])] -= 1
+            samples[slot] = values[measure]
+            histogram[FrameProfiler.bucketOf(values[measure])] += 1
+        self.itemCounts[slot] = itemCount
+        self.frames += 1
+        for phase in FrameProfiler.phases:
+            self.current[phase] = 0.
+        self.lastFrameEnd = now
+
+    @property
+    def sampleCount(self):
+        """Returns the number of frames the histograms hold"""
+        return min(self.frames, self.window)
+
+    def percentile(self, measure, fraction):
+        """Returns the duration under which fraction of the recent
+           frames spent their measure, or 0 before the first frame"""
+        count = self.sampleCount
+        if count == 0: return 0.
+        target, seen = max(1, int(math.ceil(fraction * count))), 0
+        histogram = self.histograms[measure]
+        for bucket in xrange(FrameProfiler.bucketCount):
+            seen += histogram[bucket]
+            if seen >= target: return FrameProfiler.bucketLimit(bucket)
+        return FrameProfiler.bucketLimit(FrameProfiler.bucketCount - 1)
+
+    def recent(self, values):
+        """Returns the values recorded for the recent frames, oldest
+           first"""
+        count, slot = self.sampleCount, self.frames % self.window
+        if count < self.window: return values[:count]
+        return values[slot:] + values[:slot]
+
+    def summary(self):
+        """Returns the p50, p99 and maximum of every measure, in seconds,
+           and the canvas item count of the last frame"""
+        result = {"frames": self.frames, "window": self.sampleCount, \
+                "items": self.itemCounts[(self.frames - 1) % self.window] \
+                if self.frames else 0}
+        for measure in FrameProfiler.measures:
+            result[measure] = {"p50": self.percentile(measure, .5), \
+                    "p99": self.percentile(measure, .99), \
+                    "max": max(self.recent(self.samples[measure]) or [0.])}
+        return result
+
+    def overlayLines(self):
+        """Returns the summary as short lines of text, in milliseconds"""
+        summary = self.summary()
+        lines = ["{0:10} p50 / p99 ms".format("")]
+        for measure in FrameProfiler.measures:
+            lines.append("{0:10} {1:6.2f} / {2:6.2f}".format(measure, \
+                    summary[measure]["p50"] * 1000, \
+                    summary[measure]["p99"] * 1000))
+        lines.append("{0:10} {1}".format("items", summary["items"]))
+        return lines
+
+    def dump(self, path):
+        """Writes the summary and the recent frames to a JSON file"""
+        data = {"summary": self.summary(), \
+                "items": self.recent(self.itemCounts)}
+        for measure in FrameProfiler.measures:
+            data[measure] = self.recent(self.samples[measure])
+        with open(path, "w") as f:
+            json.dump(data, f, indent = 1, sort_keys = True)
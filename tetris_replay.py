@@ -0,0 +1,413 @@
+"""Compact binary replays of games.
+
+A replay holds what is needed to rebuild a game: the seed, the rules,
+the piece set with the way it is drawn and the stream of inputs. Gravity
+steps are inputs too, so the tick of an input is the number of gravity
+steps before it. Every byte of the stream is a run of up to 32 identical
+inputs. Keyframes saved every keyframeInterval ticks let playback seek
+without replaying from the start.
+
+    python tetris_replay.py [lastgame.ttr]
+
+checks that seeking a replay, or a seeded game of random moves recorded
+on the spot, gives the same game as seeking it from a fresh player.
+"""
+import argparse
+import bisect
+import random
+import struct
+import sys
+import zlib
+from tetris_engine import Rules, Piece, PieceGenerator, GameState
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+class Replay(object):
+    """A recorded game that can be saved, loaded and played back"""
+    magic, version = b"TTRP", 2
+    moves = ["Gravity", "Left", "Right", "Down", "Up", "Return"]
+    scoringMechanisms = ["Quadratic", "Base-4 exponential"]
+    noPiece = 0xFFFF
+    # score, pieces drawn, game over, falling piece index, orientation,
+    # row and column, next piece index, palette size
+    keyframeLayout = ">QIBHBhhHB"
+
+    def __init__(self, seed, rules, pieces, events = b"", keyframes = None, \
+            strategy = "uniform", weights = None):
+        self.seed = seed
+        self.rules = rules
+        # (name, shape, color) in the order the piece generator indexes
+        self.pieces = pieces
+        # how the generator draws, with one weight per piece
+        self.strategy = strategy
+        self.weights = weights if weights != None else [1.] * len(pieces)
+        self.events = bytearray(events)
+        # (tick, offset in events, compressed game state)
+        self.keyframes = keyframes if keyframes != None else []
+        # (name, shape, color) known before newState learnt the pieces,
+        # shape and color None for pieces that were not known
+        self.replacedPieces = []
+
+    @staticmethod
+    def rulesOf(rows, cols, rotationDirection, scoringMechanism, \
+            scoringLevelDependence):
+        """Returns rules that only apply to the replayed game"""
+        rules = Rules()
+        rules.rows, rules.cols = rows, cols
+        rules.rotationDirection = rotationDirection
+        rules.scoringMechanism = scoringMechanism
+        rules.scoringLevelDependence = scoringLevelDependence
+        return rules
+
+    def toBytes(self):
+        """Returns the replay in its binary format"""
+        rules = self.rules
+        data = bytearray(Replay.magic)
+        data += struct.pack(">BQHHbBBH", Replay.version, self.seed, \
+                rules.rows, rules.cols, rules.rotationDirection, \
+                Replay.scoringMechanisms.index(rules.scoringMechanism), \
+                rules.scoringLevelDependence, len(self.pieces))
+        data += struct.pack(">B", \
+                PieceGenerator.strategies.index(self.strategy))
+        for (name, shape, color), weight in zip(self.pieces, self.weights):
+            data += Replay.packString(name) + Replay.packString(color)
+            data += struct.pack(">d", weight)
+            data += struct.pack(">BB", len(shape), len(shape[0]))
+            bits = 0
+            for row in reversed(shape):
+                for cell in reversed(row):
+                    bits = bits << 1 | bool(cell)
+            size = (len(shape) * len(shape[0]) + 7) // 8
+            data += bytearray((bits >> 8 * i) & 0xFF for i in xrange(size))
+        data += struct.pack(">I", len(self.events)) + self.events
+        data += struct.pack(">I", len(self.keyframes))
+        for tick, offset, frame in self.keyframes:
+            data += struct.pack(">III", tick, offset, len(frame)) + frame
+        return bytes(data)
+
+    @staticmethod
+    def fromBytes(data):
+        """Returns the replay stored in the binary format"""
+        data = bytearray(data)
+        if data[:4] != Replay.magic:
+            raise ValueError("not a replay")
+        version, seed, rows, cols, rotationDirection, mechanism, \
+                levelDependence, pieceCount = \
+                struct.unpack_from(">BQHHbBBH", bytes(data), 4)
+        if version != Replay.version:
+            raise ValueError("unsupported replay version {0}".format(version))
+        rules = Replay.rulesOf(rows, cols, rotationDirection, \
+                Replay.scoringMechanisms[mechanism], levelDependence)
+        offset = 4 + struct.calcsize(">BQHHbBBH")
+        strategy = PieceGenerator.strategies[data[offset]]
+        offset, pieces, weights = offset + 1, [], []
+        for p in xrange(pieceCount):
+            name, offset = Replay.unpackString(data, offset)
+            color, offset = Replay.unpackString(data, offset)
+            weights.append(struct.unpack_from(">d", bytes(data), offset)[0])
+            offset += 8
+            height, width = data[offset], data[offset + 1]
+            size = (height * width + 7) // 8
+            bits = 0
+            for i in xrange(size):
+                bits |= data[offset + 2 + i] << 8 * i
+            shape = [[bool(bits >> (i * width + j) & 1) \
+                    for j in xrange(width)] for i in xrange(height)]
+            pieces.append((name, shape, color))
+            offset += 2 + size
+        length, = struct.unpack_from(">I", bytes(data), offset)
+        events = data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+        count, = struct.unpack_from(">I", bytes(data), offset)
+        offset, keyframes = offset + 4, []
+        for k in xrange(count):
+            tick, eventOffset, size = \
+                    struct.unpack_from(">III", bytes(data), offset)
+            keyframes.append((tick, eventOffset, \
+                    bytes(data[offset + 12:offset + 12 + size])))
+            offset += 12 + size
+        rules.pieceStrategy = strategy
+        rules.pieceWeights = dict((pieces[i][0], weights[i]) \
+                for i in xrange(pieceCount))
+        return Replay(seed, rules, pieces, events, keyframes, strategy, \
+                weights)
+
+    def save(self, path):
+        """Writes the replay to a file"""
+        with open(path, "wb") as f:
+            f.write(self.toBytes())
+
+    @staticmethod
+    def load(path):
+        """Reads a replay from a file"""
+        with open(path, "rb") as f:
+            return Replay.fromBytes(f.read())
+
+    @staticmethod
+    def packString(text):
+        encoded = text.encode("utf-8")
+        return bytearray(struct.pack(">H", len(encoded))) + encoded
+
+    @staticmethod
+    def unpackString(data, offset):
+        length, = struct.unpack_from(">H", bytes(data), offset)
+        text = bytes(data[offset + 2:offset + 2 + length]).decode("utf-8")
+        return text, offset + 2 + length
+
+    def newState(self):
+        """Returns the game state the replay starts from.
+           The pieces of the replay are learnt until forgetPieces is
+           called, which puts back the pieces they replaced.
+        """
+        for name, shape, color in self.pieces:
+            knownShape = Piece.knownShapes.get(name)
+            knownColor = Piece.knownColors.get(name)
+            if knownShape == shape and knownColor == color: continue
+            Piece.learnPiece(name, shape, color)
+            self.replacedPieces.append((name, knownShape, knownColor))
+        names = [name for name, shape, color in self.pieces]
+        generator = PieceGenerator(names, self.seed, self.strategy, \
+                dict(zip(names, self.weights)))
+        state = GameState(self.rules, self.seed, generator)
+        state.start()
+        return state
+
+    def forgetPieces(self):
+        """Puts the piece database back as it was before newState"""
+        while self.replacedPieces:
+            name, shape, color = self.replacedPieces.pop()
+            if shape == None:
+                Piece.forgetPiece(name)
+            else:
+                Piece.learnPiece(name, shape, color)
+
+    def encodeState(self, state):
+        """Returns a compressed keyframe of a game state"""
+        names = [name for name, shape, color in self.pieces]
+        falling, nextPiece = state.fallingPiece, state.nextPiece
+        data = bytearray(struct.pack(Replay.keyframeLayout, state.score, \
+                state.piecesDrawn, state.isOver, \
+                Replay.noPiece if falling == None else \
+                names.index(falling.name), \
+                0 if falling == None else falling.orientation, \
+                0 if falling == None else falling.position[0], \
+                0 if falling == None else falling.position[1], \
+                Replay.noPiece if nextPiece == None else \
+                names.index(nextPiece.name), \
+                len(state.palette)))
+        for color in state.palette:
+            data += Replay.packString(color)
+        for row in state.cellColors:
+            data += row
+        return zlib.compress(bytes(data))
+
+    def decodeState(self, state, frame):
+        """Puts a game state back to a keyframe"""
+        data = bytearray(zlib.decompress(frame))
+        score, piecesDrawn, isOver, fallingIndex, orientation, row, col, \
+                nextIndex, paletteSize = \
+                struct.unpack_from(Replay.keyframeLayout, bytes(data))
+        offset, palette = struct.calcsize(Replay.keyframeLayout), []
+        for i in xrange(paletteSize):
+            color, offset = Replay.unpackString(data, offset)
+            palette.append(color)
+        state.score, state.isOver = score, bool(isOver)
+        state.rewindRandom(piecesDrawn)
+        # the keyframe indexes the palette it was saved with
+        table = bytearray(Piece.colorIndex(color) for color in palette)
+        table = bytes(table + bytearray(256 - len(table)))
+        state.fallingPiece, state.nextPiece = None, None
+        if fallingIndex != Replay.noPiece:
+            state.fallingPiece = Piece(self.pieces[fallingIndex][0], \
+                    state.cols)
+            state.fallingPiece.orientation = orientation
+            state.fallingPiece.position = [row, col]
+        if nextIndex != Replay.noPiece:
+            state.nextPiece = Piece(self.pieces[nextIndex][0], state.cols)
+        for i in xrange(state.rows):
+            start = offset + i * state.cols
+            colors = data[start:start + state.cols].translate(table)
+            state.bitboard[i] = sum(1 << j for j in xrange(state.cols) \
+                    if colors[j])
+            state.cellColors[i] = colors if state.bitboard[i] else \
+                    state.emptyRow
+        state.ownedRows = 0
+        state.updateColumnTops()
+        state.updateBoardHash()
+
+class ReplayRecorder(object):
+    """Records the inputs applied to a game state into a Replay.
+       Call record after every input has been applied.
+    """
+    def __init__(self, state, keyframeInterval = 600):
+        generator = state.generator
+        pieces = [(name, Piece.knownShapes[name], Piece.knownColors[name]) \
+                for name in generator.names]
+        self.replay = Replay(state.seed, state.rules, pieces, \
+                strategy = generator.strategy, weights = generator.weights)
+        self.state = state
+        self.keyframeInterval = keyframeInterval
+        self.tick = 0
+        self.pendingCode, self.pendingCount = None, 0
+
+    def record(self, move):
+        """Records a move: a key symbol or "Gravity" for a gravity step"""
+        code = Replay.moves.index(move)
+        if code != self.pendingCode or self.pendingCount == 32:
+            self.flush()
+            self.pendingCode = code
+        self.pendingCount += 1
+        if code == 0:
+            self.tick += 1
+            if self.tick % self.keyframeInterval == 0:
+                self.flush()
+                self.replay.keyframes.append((self.tick, \
+                        len(self.replay.events), \
+                        self.replay.encodeState(self.state)))
+
+    def flush(self):
+        """Writes the pending run of inputs to the event stream"""
+        if self.pendingCount != 0:
+            self.replay.events.append((self.pendingCount - 1) << 3 | \
+                    self.pendingCode)
+        self.pendingCode, self.pendingCount = None, 0
+
+    def save(self, path):
+        """Writes the replay recorded so far to a file"""
+        self.flush()
+        self.replay.save(path)
+
+class ReplayPlayer(object):
+    """Plays a Replay back on a fresh game state"""
+    def __init__(self, replay):
+        self.replay = replay
+        self.state = replay.newState()
+        self.tick, self.offset = 0, 0
+        self.pendingCode, self.pendingCount = None, 0
+        # offset and pending count right after the last gravity step,
+        # to tell whether inputs of the current tick were applied since
+        self.tickEnd = (0, 0)
+        self.keyframeTicks = [tick for tick, offset, frame in replay.keyframes]
+
+    @property
+    def isFinished(self):
+        return self.pendingCount == 0 and \
+                self.offset >= len(self.replay.events)
+
+    def step(self):
+        """Applies the next input. Returns it, or None at the end."""
+        if self.pendingCount == 0:
+            if self.offset >= len(self.replay.events): return None
+            byte = self.replay.events[self.offset]
+            self.offset += 1
+            self.pendingCode, self.pendingCount = byte & 7, (byte >> 3) + 1
+        self.pendingCount -= 1
+        move = Replay.moves[self.pendingCode]
+        if self.pendingCode == 0:
+            self.state.moveFallingPiece(1, 0)
+            self.tick += 1
+            self.tickEnd = (self.offset, self.pendingCount)
+        else:
+            self.state.applyMove(move)
+        return move
+
+    def stepTick(self):
+        """Applies inputs up to and including the next gravity step.
+           Returns whether there was one."""
+        while True:
+            move = self.step()
+            if move == None: return False
+            if move == "Gravity": return True
+
+    def playToEnd(self):
+        """Plays the rest of the replay as fast as possible"""
+        while self.step() != None:
+            pass
+
+    def seek(self, tick):
+        """Moves the game to right after the gravity step of a tick,
+           starting from the closest keyframe at or before it"""
+        k = bisect.bisect_right(self.keyframeTicks, tick) - 1
+        # inputs played after the gravity step of the tick cannot be undone
+        pastTickEnd = (self.offset, self.pendingCount) != self.tickEnd
+        if tick < self.tick or (tick == self.tick and pastTickEnd) or \
+                (k >= 0 and self.keyframeTicks[k] > self.tick):
+            if k >= 0:
+                keyTick, offset, frame = self.replay.keyframes[k]
+                self.replay.decodeState(self.state, frame)
+                self.tick, self.offset = keyTick, offset
+            else:
+                self.state = self.replay.newState()
+                self.tick, self.offset = 0, 0
+            self.pendingCode, self.pendingCount = None, 0
+            self.tickEnd = (self.offset, 0)
+        while self.tick < tick and self.stepTick():
+            pass
+
+    def fingerprint(self):
+        """Returns what seeking must restore of the game state"""
+        state = self.state
+        falling, nextPiece = state.fallingPiece, state.nextPiece
+        return (list(state.bitboard), \
+                [bytes(row) for row in state.cellColors], state.score, \
+                state.isOver, state.piecesDrawn, None if falling == None \
+                else (falling.name, falling.orientation, \
+                tuple(falling.position)), \
+                None if nextPiece == None else nextPiece.name)
+
+    @staticmethod
+    def checkSeek(replay):
+        """Seeks every tick of a replay after playing it to the end, and
+           returns the ticks where the game differs from a fresh seek"""
+        player = ReplayPlayer(replay)
+        player.playToEnd()
+        mismatches = []
+        for tick in xrange(player.tick + 1):
+            fresh = ReplayPlayer(replay)
+            fresh.seek(tick)
+            player.playToEnd()
+            player.seek(tick)
+            if player.fingerprint() != fresh.fingerprint():
+                mismatches.append(tick)
+        return mismatches
+
+def recordRandomGame(seed, ticks = 300, keyframeInterval = 20):
+    """Returns the replay of a seeded game of random moves"""
+    Piece.learnStandardPieces()
+    state = GameState(Rules(), seed)
+    state.start()
+    recorder = ReplayRecorder(state, keyframeInterval)
+    rng = random.Random(seed)
+    while recorder.tick < ticks and not state.isOver:
+        move = rng.choice(Replay.moves)
+        if move == "Gravity":
+            state.moveFallingPiece(1, 0)
+        else:
+            state.applyMove(move)
+        recorder.record(move)
+    recorder.flush()
+    return recorder.replay
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = \
+            "Checks that seeking a replay restores the same games.")
+    parser.add_argument("replay", nargs = "?", \
+            help = "the replay to check, a random game by default")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args(argv)
+    replay = Replay.load(args.replay) if args.replay else \
+            recordRandomGame(args.seed)
+    mismatches = ReplayPlayer.checkSeek(replay)
+    replay.forgetPieces()
+    if mismatches:
+        sys.stderr.write("seeking differs at ticks {0}\n".format(\
+                ", ".join(str(tick) for tick in mismatches)))
+        return 1
+    sys.stderr.write("seeking ok\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Fixed-timestep scheduling on top of the Tk event loop.
+
+Tk's after only promises to wait at least the delay, so a timer that
+re-arms itself drifts a little on every step. The Scheduler instead
+polls every frameDelay milliseconds, measures the real time elapsed and
+runs as many simulation steps as fit in it, so steps keep their pace
+however late the frames are.
+"""
+import timeit
+
+class Scheduler(object):
+    """Calls tick once every stepDelay() milliseconds of real time and
+       render once per frame, on any widget with after and after_cancel.
+       render gets the fraction of a step accumulated since the last
+       tick, for views that interpolate between steps. poll, if given,
+       is called at the start of every frame, before the steps.
+       A frame runs at most maxSteps ticks; time beyond that is dropped
+       so a long stall does not replay a burst of steps.
+    """
+    def __init__(self, widget, tick, render, stepDelay, poll = None, \
+            frameDelay = 16, maxSteps = 5, clock = timeit.default_timer):
+        self.widget = widget
+        self.tick, self.render, self.poll = tick, render, poll
+        self.stepDelay = stepDelay
+        self.frameDelay, self.maxSteps = frameDelay, maxSteps
+        self.clock = clock
+        self.pending = None
+        self.accumulated, self.lastFrame = 0., None
+
+    @property
+    def isRunning(self):
+        return self.pending != None
+
+    def start(self):
+        """Starts or resumes stepping. Does nothing when running, so
+           there is never more than one frame pending."""
+        if self.isRunning: return
+        self.lastFrame = self.clock()
+        self.pending = self.widget.after(self.frameDelay, self.frame)
+
+    def stop(self):
+        """Stops stepping. The time accumulated towards the next step
+           is kept for when it is started again."""
+        if self.isRunning:
+            self.widget.after_cancel(self.pending)
+            self.pending = None
+
+    def reset(self):
+        """Forgets the time accumulated towards the next step"""
+        self.accumulated = 0.
+
+    def frame(self):
+        """Runs the steps that are due, then renders"""
+        self.pending = self.widget.after(self.frameDelay, self.frame)
+        if self.poll != None: self.poll()
+        now = self.clock()
+        self.accumulated += now - self.lastFrame
+        self.lastFrame = now
+        step, steps = self.stepDelay() / 1000., 0
+        while self.isRunning and self.accumulated >= step:
+            self.accumulated -= step
+            self.tick()
+            steps += 1
+            if steps == self.maxSteps:
+                self.accumulated = min(self.accumulated, step)
+                break
+            step = self.stepDelay() / 1000.
+        if self.isRunning: self.render(self.accumulated / step)
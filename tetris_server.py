@@ -0,0 +1,477 @@
+"""Headless game server hosting many independent sessions in one process.
+
+    python3 tetris_server.py serve [--port 7777 | --unix PATH]
+    python3 tetris_server.py client [--port 7777 | --unix PATH | --local]
+            [--sessions 10000] [--play 10]
+
+Every session is a GameState with its own rules, board, piece stream and
+gravity timer, all on one asyncio event loop. A session only costs its
+game state until it is started; its gravity timer runs while it plays.
+The client is a stand-in for remote players: it opens idle sessions,
+plays a few of them with random moves and checks the games it gets back.
+With --local it runs its own server, so everything can be tried without
+a network. Python 3 only.
+
+Every message is a header, its type and the length of its payload
+(">BI"), then the payload, all big-endian. Every request gets exactly
+one reply, in order; gravity steps are pushed as they happen.
+
+    request                          reply
+    newSession   rows H, cols H,     created  session I, replay header
+                 rotation b,                  (the rules, seed and
+                 scoring B,                   pieces, see Replay)
+                 levelDependence B,
+                 strategy B,
+                 hasSeed B, seed Q
+    start        session I           updated  update
+    pause        session I           updated  update
+    move         session I, move B   updated  update
+    getState     session I           frame    session I, keyframe
+                                              (see Replay.encodeState)
+    close        session I           closed   session I
+    any, failed                      error    request B, code B,
+                                              session I
+    pushed on every gravity step:    ticked   update
+
+An update is ">IQIIBHBhhH": session, score, pieces drawn, gravity steps,
+game over, falling piece index (0xFFFF for none), its orientation, row
+and column, next piece index. Moves are indexes into Replay.moves, from
+1 as gravity is the server's.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from tetris_engine import Piece, PieceGenerator, GameState
+from tetris_replay import Replay
+from tetris_library import PieceLibrary
+
+Update = collections.namedtuple("Update", ["session", "score", \
+        "piecesDrawn", "ticks", "isOver", "fallingPiece", "orientation", \
+        "row", "col", "nextPiece"])
+
+class Protocol(object):
+    """Message types, layouts and error codes of the binary protocol"""
+    header = struct.Struct(">BI")
+    newSession, start, pause, move, getState, close = range(1, 7)
+    created, updated, frame, closed, ticked, error = \
+            0x81, 0x82, 0x83, 0x84, 0x90, 0xFF
+    newSessionLayout = struct.Struct(">HHbBBBBQ")
+    sessionLayout = struct.Struct(">I")
+    moveLayout = struct.Struct(">IB")
+    updateLayout = struct.Struct(">IQIIBHBhhH")
+    errorLayout = struct.Struct(">BBI")
+    unknownSession, badRequest, notPlaying, tooManySessions = range(1, 5)
+    # requests are small; anything longer is not from a client
+    maxRequestLength = 64
+
+    @staticmethod
+    def message(kind, payload = b""):
+        return Protocol.header.pack(kind, len(payload)) + payload
+
+class Session(object):
+    """One game on the server, owned by the connection that created it"""
+    __slots__ = ("id", "state", "owner", "timer", "nextTick", "ticks")
+
+    def __init__(self, id, state, owner):
+        self.id, self.state, self.owner = id, state, owner
+        self.timer, self.nextTick, self.ticks = None, 0., 0
+
+    @property
+    def isPlaying(self):
+        return self.timer != None
+
+class GameServer(object):
+    """Hosts game sessions for clients over TCP or a Unix socket.
+       All sessions draw from the pieces known when it is created.
+    """
+    # boards bigger than this are refused
+    maxRows, maxCols = 1000, 256
+    minRows, minCols = 4, 4
+
+    def __init__(self, maxSessions = 100000):
+        self.names = Piece.knownNames()
+        self.pieces = [(name, Piece.knownShapes[name], \
+                Piece.knownColors[name]) for name in self.names]
+        self.indexes = dict((name, i) for i, name in enumerate(self.names))
+        self.maxSessions = maxSessions
+        self.sessions = {}
+        self.lastId = 0
+        self.random = random.Random()
+        self.handlers = {Protocol.newSession: self.newSession, \
+                Protocol.start: self.start, Protocol.pause: self.pause, \
+                Protocol.move: self.move, Protocol.getState: self.getState, \
+                Protocol.close: self.close}
+
+    def serve(self, host = "127.0.0.1", port = 7777):
+        """Returns a coroutine that starts serving over TCP"""
+        return asyncio.start_server(self.handleConnection, host, port)
+
+    def serveUnix(self, path):
+        """Returns a coroutine that starts serving on a Unix socket"""
+        return asyncio.start_unix_server(self.handleConnection, path)
+
+    async def handleConnection(self, reader, writer):
+        """Serves the requests of one client until it disconnects.
+           Its sessions end with the connection.
+        """
+        owned = set()
+        try:
+            while True:
+                kind, length = Protocol.header.unpack(\
+                        await reader.readexactly(Protocol.header.size))
+                if length > Protocol.maxRequestLength: break
+                payload = await reader.readexactly(length)
+                self.handle(kind, payload, writer, owned)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for sessionId in list(owned):
+                self.endSession(self.sessions[sessionId], owned)
+            writer.close()
+
+    def handle(self, kind, payload, writer, owned):
+        """Answers one request"""
+        handler = self.handlers.get(kind)
+        sessionId = 0
+        try:
+            if handler == None: raise ServerError(Protocol.badRequest)
+            if kind != Protocol.newSession:
+                sessionId, = Protocol.sessionLayout.unpack_from(payload)
+                if sessionId not in owned:
+                    raise ServerError(Protocol.unknownSession)
+            reply = handler(payload, writer, owned)
+        except struct.error:
+            reply = self.errorMessage(kind, Protocol.badRequest, sessionId)
+        except ServerError as e:
+            reply = self.errorMessage(kind, e.code, sessionId)
+        writer.write(reply)
+
+    def errorMessage(self, kind, code, sessionId):
+        return Protocol.message(Protocol.error, \
+                Protocol.errorLayout.pack(kind, code, sessionId))
+
+    def newSession(self, payload, writer, owned):
+        rows, cols, rotationDirection, mechanism, levelDependence, \
+                strategy, hasSeed, seed = \
+                Protocol.newSessionLayout.unpack(payload)
+        if not (GameServer.minRows <= rows <= GameServer.maxRows and \
+                GameServer.minCols <= cols <= GameServer.maxCols and \
+                rotationDirection in (-1, 1) and \
+                mechanism < len(Replay.scoringMechanisms) and \
+                levelDependence in (0, 1) and \
+                strategy < len(PieceGenerator.strategies)):
+            raise ServerError(Protocol.badRequest)
+        if len(self.sessions) >= self.maxSessions:
+            raise ServerError(Protocol.tooManySessions)
+        rules = Replay.rulesOf(rows, cols, rotationDirection, \
+                Replay.scoringMechanisms[mechanism], levelDependence)
+        rules.pieceStrategy = PieceGenerator.strategies[strategy]
+        if not hasSeed: seed = self.random.getrandbits(32)
+        state = GameState(rules, seed, PieceGenerator(self.names, seed, \
+                rules.pieceStrategy))
+        state.start()
+        self.lastId += 1
+        session = Session(self.lastId, state, writer)
+        self.sessions[session.id] = session
+        owned.add(session.id)
+        return Protocol.message(Protocol.created, \
+                Protocol.sessionLayout.pack(session.id) + \
+                self.replayOf(state).toBytes())
+
+    def replayOf(self, state):
+        """Returns an empty replay of a session's game, to describe it"""
+        return Replay(state.seed, state.rules, self.pieces, \
+                strategy = state.generator.strategy)
+
+    def start(self, payload, writer, owned):
+        """Starts or resumes the gravity of a session"""
+        session = self.sessions[Protocol.sessionLayout.unpack(payload)[0]]
+        if not session.isPlaying and not session.state.isOver:
+            loop = asyncio.get_event_loop()
+            session.nextTick = loop.time() + \
+                    session.state.gravityDelay / 1000.
+            session.timer = loop.call_at(session.nextTick, self.tick, \
+                    session)
+        return self.updateMessage(Protocol.updated, session)
+
+    def pause(self, payload, writer, owned):
+        session = self.sessions[Protocol.sessionLayout.unpack(payload)[0]]
+        self.stopGravity(session)
+        return self.updateMessage(Protocol.updated, session)
+
+    def move(self, payload, writer, owned):
+        sessionId, code = Protocol.moveLayout.unpack(payload)
+        session = self.sessions[sessionId]
+        if not 1 <= code < len(Replay.moves):
+            raise ServerError(Protocol.badRequest)
+        if not session.isPlaying: raise ServerError(Protocol.notPlaying)
+        session.state.applyMove(Replay.moves[code])
+        if session.state.isOver: self.stopGravity(session)
+        return self.updateMessage(Protocol.updated, session)
+
+    def getState(self, payload, writer, owned):
+        session = self.sessions[Protocol.sessionLayout.unpack(payload)[0]]
+        return Protocol.message(Protocol.frame, \
+                Protocol.sessionLayout.pack(session.id) + \
+                self.replayOf(session.state).encodeState(session.state))
+
+    def close(self, payload, writer, owned):
+        session = self.sessions[Protocol.sessionLayout.unpack(payload)[0]]
+        self.endSession(session, owned)
+        return Protocol.message(Protocol.closed, \
+                Protocol.sessionLayout.pack(session.id))
+
+    def endSession(self, session, owned):
+        self.stopGravity(session)
+        del self.sessions[session.id]
+        owned.discard(session.id)
+
+    def stopGravity(self, session):
+        if session.isPlaying:
+            session.timer.cancel()
+            session.timer = None
+
+    def tick(self, session):
+        """Runs a gravity step of a session and schedules the next one.
+           Steps keep to the real time; when the loop falls behind, the
+           steps missed are dropped rather than run in a burst.
+        """
+        state = session.state
+        state.moveFallingPiece(1, 0)
+        session.ticks += 1
+        if state.isOver:
+            session.timer = None
+        else:
+            loop = asyncio.get_event_loop()
+            session.nextTick = max(session.nextTick + \
+                    state.gravityDelay / 1000., loop.time())
+            session.timer = loop.call_at(session.nextTick, self.tick, \
+                    session)
+        if not session.owner.is_closing():
+            session.owner.write(self.updateMessage(Protocol.ticked, session))
+
+    def updateMessage(self, kind, session):
+        state = session.state
+        falling, nextPiece = state.fallingPiece, state.nextPiece
+        return Protocol.message(kind, Protocol.updateLayout.pack(session.id, \
+                state.score, state.piecesDrawn, session.ticks, state.isOver, \
+                Replay.noPiece if falling == None else \
+                self.indexes[falling.name], \
+                0 if falling == None else falling.orientation, \
+                0 if falling == None else falling.position[0], \
+                0 if falling == None else falling.position[1], \
+                Replay.noPiece if nextPiece == None else \
+                self.indexes[nextPiece.name]))
+
+class ServerError(Exception):
+    """A request that cannot be served, with the error code to send"""
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+class GameClient(object):
+    """Plays sessions on a GameServer. Replies are matched to requests
+       in order; the updates pushed by gravity steps are kept in
+       updates, the last one per session.
+    """
+    def __init__(self):
+        self.reader, self.writer = None, None
+        self.pending = collections.deque()
+        self.replays, self.updates = {}, {}
+        self.listener = None
+
+    async def connect(self, host = "127.0.0.1", port = 7777):
+        self.reader, self.writer = \
+                await asyncio.open_connection(host, port)
+        self.listener = asyncio.ensure_future(self.listen())
+
+    async def connectUnix(self, path):
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+        self.listener = asyncio.ensure_future(self.listen())
+
+    async def disconnect(self):
+        self.writer.close()
+        await self.listener
+
+    async def listen(self):
+        """Reads the messages of the server until it disconnects"""
+        try:
+            while True:
+                kind, length = Protocol.header.unpack(await \
+                        self.reader.readexactly(Protocol.header.size))
+                payload = await self.reader.readexactly(length)
+                if kind == Protocol.ticked:
+                    update = Update(*Protocol.updateLayout.unpack(payload))
+                    self.updates[update.session] = update
+                else:
+                    self.pending.popleft().set_result((kind, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            while self.pending:
+                self.pending.popleft().set_exception(\
+                        ConnectionError("disconnected from the server"))
+
+    async def request(self, kind, payload):
+        """Sends a request and returns the payload of its reply"""
+        reply = asyncio.get_event_loop().create_future()
+        self.pending.append(reply)
+        self.writer.write(Protocol.message(kind, payload))
+        replyKind, replyPayload = await reply
+        if replyKind == Protocol.error:
+            request, code, session = \
+                    Protocol.errorLayout.unpack(replyPayload)
+            raise ServerError(code)
+        return replyPayload
+
+    async def newSession(self, rows = 15, cols = 10, seed = None, \
+            rotationDirection = -1, scoringMechanism = "Quadratic", \
+            scoringLevelDependence = 0, strategy = "uniform"):
+        """Creates a session. Returns its id; its rules, seed and pieces
+           are in replays."""
+        payload = await self.request(Protocol.newSession, \
+                Protocol.newSessionLayout.pack(rows, cols, \
+                rotationDirection, \
+                Replay.scoringMechanisms.index(scoringMechanism), \
+                scoringLevelDependence, \
+                PieceGenerator.strategies.index(strategy), seed != None, \
+                seed or 0))
+        sessionId, = Protocol.sessionLayout.unpack_from(payload)
+        self.replays[sessionId] = \
+                Replay.fromBytes(payload[Protocol.sessionLayout.size:])
+        return sessionId
+
+    async def updateRequest(self, kind, payload):
+        update = Update(*Protocol.updateLayout.unpack(\
+                await self.request(kind, payload)))
+        self.updates[update.session] = update
+        return update
+
+    def start(self, sessionId):
+        return self.updateRequest(Protocol.start, \
+                Protocol.sessionLayout.pack(sessionId))
+
+    def pause(self, sessionId):
+        return self.updateRequest(Protocol.pause, \
+                Protocol.sessionLayout.pack(sessionId))
+
+    def move(self, sessionId, move):
+        """Plays a move, a key symbol of Replay.moves"""
+        return self.updateRequest(Protocol.move, \
+                Protocol.moveLayout.pack(sessionId, Replay.moves.index(move)))
+
+    async def state(self, sessionId):
+        """Returns a copy of the game state of a session"""
+        payload = await self.request(Protocol.getState, \
+                Protocol.sessionLayout.pack(sessionId))
+        replay = self.replays[sessionId]
+        state = replay.newState()
+        replay.decodeState(state, payload[Protocol.sessionLayout.size:])
+        return state
+
+    async def close(self, sessionId):
+        await self.request(Protocol.close, \
+                Protocol.sessionLayout.pack(sessionId))
+        self.replays.pop(sessionId).forgetPieces()
+        self.updates.pop(sessionId, None)
+
+def maxResidentMegabytes():
+    """Returns the peak memory of the process, if it can be known"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. * 1024 if sys.platform == "darwin" else 1024.)
+
+async def runClient(args):
+    """Opens idle sessions, plays some of them, then checks their games"""
+    client, server = GameClient(), None
+    if args.local:
+        path = os.path.join(tempfile.mkdtemp(), "tetris.sock")
+        server = await GameServer().serveUnix(path)
+        await client.connectUnix(path)
+    elif args.unix:
+        await client.connectUnix(args.unix)
+    else:
+        await client.connect(args.host, args.port)
+    start = time.time()
+    sessionIds = await asyncio.gather(*[client.newSession(seed = k) \
+            for k in range(args.sessions)])
+    elapsed = time.time() - start
+    sys.stdout.write("{0} sessions opened in {1:.2f} s, peak memory {2}\n" \
+            .format(len(sessionIds), elapsed, maxResidentMegabytes()))
+    # mostly moves, with a hard drop now and then
+    rng, moves = random.Random(0), ["Left", "Right", "Down", "Up"] * 3 + \
+            ["Return"]
+    played = sessionIds[:args.play]
+    for sessionId in played:
+        await client.start(sessionId)
+    for k in range(args.moves):
+        for sessionId in played:
+            try:
+                await client.move(sessionId, rng.choice(moves))
+            except ServerError:
+                # the game is over
+                pass
+        await asyncio.sleep(0.01)
+    for sessionId in played:
+        update = await client.pause(sessionId)
+        state = await client.state(sessionId)
+        if (state.score, state.piecesDrawn, state.isOver) != \
+                (update.score, update.piecesDrawn, bool(update.isOver)):
+            raise RuntimeError("session {0} is out of sync".format(sessionId))
+        sys.stdout.write("session {0}: score {1}, {2} pieces, {3} gravity " \
+                "steps{4}\n".format(sessionId, update.score, \
+                update.piecesDrawn, update.ticks, \
+                ", over" if update.isOver else ""))
+    await client.disconnect()
+    if server != None:
+        server.close()
+        await server.wait_closed()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = \
+            "Hosts game sessions, or plays on them as a stand-in client.")
+    parser.add_argument("mode", choices = ("serve", "client"))
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 7777)
+    parser.add_argument("--unix", metavar = "PATH", \
+            help = "use a Unix socket instead of TCP")
+    parser.add_argument("--library", metavar = "PATH", \
+            help = "piece library to play with, standard pieces if none")
+    parser.add_argument("--local", action = "store_true", \
+            help = "client: run the server in the same process")
+    parser.add_argument("--sessions", type = int, default = 10000, \
+            help = "client: sessions to open")
+    parser.add_argument("--play", type = int, default = 10, \
+            help = "client: sessions to play")
+    parser.add_argument("--moves", type = int, default = 100, \
+            help = "client: moves played in every session played")
+    args = parser.parse_args(argv)
+    if args.library == None or PieceLibrary(args.library).load() == None:
+        Piece.learnStandardPieces()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if args.mode == "client":
+        loop.run_until_complete(runClient(args))
+        return 0
+    server = GameServer()
+    loop.run_until_complete(server.serveUnix(args.unix) if args.unix \
+            else server.serve(args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())